@@ -6,21 +6,36 @@ from pathlib import Path
 BASE_DIR = Path(__file__).parent.parent
 UPLOAD_DIR = BASE_DIR / "uploads"
 RESULTS_DIR = BASE_DIR / "results"
+LIBRARY_CACHE_DIR = UPLOAD_DIR / ".cache"
+MS2QUERY_CACHE_DIR = RESULTS_DIR / "ms2query_cache"
+MS2QUERY_MODELS_DIR = Path(os.environ.get("MS2QUERY_MODELS_DIR", BASE_DIR / "ms2query_models"))
 UPLOAD_DIR.mkdir(exist_ok=True)
 
 # File upload settings
 MAX_UPLOAD_SIZE = 500 * 1024 * 1024  # 500 MB
+UPLOAD_CHUNK_SIZE = 1024 * 1024  # 1 MB read/write chunks when saving uploads
 ALLOWED_EXTENSIONS = {
     "xcms": [".csv"],
     "mzxml": [".mzxml", ".mzXML"],
-    "library": [".msp", ".mgf", ".json", ".mzml", ".mzML"]
+    "library": [".msp", ".mgf", ".json", ".json.gz", ".json.zst", ".mzml", ".mzML"]
 }
 
+# Data loading settings
+XCMS_CSV_CHUNK_ROWS = 50_000  # rows parsed per chunk
+
 # MS2 extraction settings
 DEFAULT_MZ_TOLERANCE = 0.01  # Da
 DEFAULT_RT_TOLERANCE = 30.0  # seconds
 
 # Matching settings
 DEFAULT_MATCHING_ALGORITHM = "ms2query"
-AVAILABLE_ALGORITHMS = ["ms2query", "dot_product", "cosine", "modified_cosine"]
+MS2QUERY_MODEL_SUFFIXES = {".model", ".npy", ".pt", ".hdf5", ".onnx"}  # pretrained model files
+AVAILABLE_ALGORITHMS = ["ms2query", "dot_product", "cosine", "modified_cosine", "binned_cosine", "sparse_cosine", "gpu_cosine"]
+MATCHING_WORKERS = os.cpu_count() or 1  # threads matching MS2Query queries one by one
+MATCHING_PARALLEL_MIN_QUERIES = 64  # below this, MS2Query matches queries on one thread
+BINNED_BIN_WIDTH = 1.0  # Da, nominal-mass bins for binned_cosine
+BINNED_MZ_MAX = 2000.0  # upper m/z edge of the binned_cosine grid
+BINNED_BLOCK_ROWS = 4096  # float16 library rows widened to float32 per matrix product
+SPARSE_BIN_WIDTH = 0.01  # Da, high-resolution bins for sparse_cosine
+GPU_QUERY_BATCH = 1024  # queries scored per GPU matrix product in gpu_cosine
 
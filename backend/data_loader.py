@@ -1,52 +1,245 @@
 """Load and parse XCMS results."""
+import numpy as np
 import pandas as pd
+from dataclasses import dataclass, field
 from pathlib import Path
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Iterator, Optional, Union
+from backend.config import XCMS_CSV_CHUNK_ROWS
 
+try:
+    import pyarrow as pa
+    from pyarrow import csv as pa_csv
+    PYARROW_AVAILABLE = True
+except ImportError:
+    PYARROW_AVAILABLE = False
 
-def load_xcms_data(csv_path: Path) -> List[Dict[str, Any]]:
+# Non-sample columns of an XCMS peak table; every other column holds sample intensities
+XCMS_META_COLUMNS = frozenset({"name", "mz", "mzmin", "mzmax", "rt", "rtmin", "rtmax", "npeaks", "."})
+
+
+@dataclass
+class PeakTable:
+    """
+    XCMS peaks stored both as dictionaries and as column arrays.
+    
+    The dictionaries are what the API returns; the ``mz`` and ``rt`` arrays
+    run parallel to them and back the vectorized range queries. The arrays
+    are float32, which is ample for m/z and RT tolerance searches and halves
+    the memory traffic of each query.
+    
+    Derived at construction time:
+    
+    - ``by_name`` maps each feature name to its (first) peak for
+      constant-time lookups.
+    - ``mz_order`` sorts the peaks by m/z; ``mz_sorted`` and ``rt_by_mz``
+      are the m/z and RT arrays in that order, for binary-search queries
+      (see query_mz_window).
+    """
+    peaks: List[Dict[str, Any]]
+    mz: np.ndarray
+    rt: np.ndarray
+    by_name: Dict[str, Dict[str, Any]] = field(init=False, repr=False)
+    mz_order: np.ndarray = field(init=False, repr=False)
+    mz_sorted: np.ndarray = field(init=False, repr=False)
+    rt_by_mz: np.ndarray = field(init=False, repr=False)
+    
+    def __post_init__(self):
+        # Insert in reverse so the first peak wins when names repeat
+        self.by_name = {p.get("name"): p for p in reversed(self.peaks)}
+        self.mz_order = np.argsort(self.mz, kind="stable")
+        self.mz_sorted = self.mz[self.mz_order]
+        self.rt_by_mz = self.rt[self.mz_order]
+    
+    @classmethod
+    def from_peaks(cls, peaks: List[Dict[str, Any]]) -> "PeakTable":
+        """Build a peak table from a list of peak dictionaries."""
+        return cls(
+            peaks=peaks,
+            mz=np.array([p.get("mz", 0) for p in peaks], dtype=np.float32),
+            rt=np.array([p.get("rt", 0) for p in peaks], dtype=np.float32)
+        )
+    
+    def __len__(self) -> int:
+        return len(self.peaks)
+    
+    def __iter__(self):
+        return iter(self.peaks)
+
+
+PeaksLike = Union[PeakTable, List[Dict[str, Any]]]
+
+
+def as_peak_table(peaks: PeaksLike) -> PeakTable:
+    """Return ``peaks`` as a PeakTable, building the column arrays if needed."""
+    if isinstance(peaks, PeakTable):
+        return peaks
+    return PeakTable.from_peaks(peaks)
+
+
+def query_mz_window(table: PeakTable, mz_lo: float, mz_hi: float) -> np.ndarray:
+    """
+    Find peaks with m/z in ``[mz_lo, mz_hi]`` by binary search.
+    
+    Args:
+        table: Peak table
+        mz_lo: Lower m/z bound (inclusive)
+        mz_hi: Upper m/z bound (inclusive)
+        
+    Returns:
+        Indices into ``table.peaks``, ordered by m/z
+    """
+    lo = np.searchsorted(table.mz_sorted, mz_lo, side="left")
+    hi = np.searchsorted(table.mz_sorted, mz_hi, side="right")
+    return table.mz_order[lo:hi]
+
+
+def _numeric_column(chunk: pd.DataFrame, col: str, dtype: type) -> np.ndarray:
+    """Return a numeric column as an array, defaulting missing values to 0."""
+    if col not in chunk.columns:
+        return np.zeros(len(chunk), dtype=dtype)
+    return chunk[col].fillna(0).to_numpy(dtype=dtype)
+
+
+def _chunk_to_records(chunk: pd.DataFrame, sample_cols: List[str]) -> List[Dict[str, Any]]:
+    """Convert one chunk of the XCMS peak table to peak dictionaries."""
+    n_rows = len(chunk)
+    names = chunk["name"].astype(str).tolist() if "name" in chunk.columns else [""] * n_rows
+    mz = _numeric_column(chunk, "mz", float).tolist()
+    mzmin = _numeric_column(chunk, "mzmin", float).tolist()
+    mzmax = _numeric_column(chunk, "mzmax", float).tolist()
+    rt = _numeric_column(chunk, "rt", float).tolist()
+    rtmin = _numeric_column(chunk, "rtmin", float).tolist()
+    rtmax = _numeric_column(chunk, "rtmax", float).tolist()
+    npeaks = _numeric_column(chunk, "npeaks", int).tolist()
+    
+    # Sample columns are not pinned to a dtype: annotation columns (e.g. CAMERA's
+    # isotopes/adduct) hold text, and non-numeric values are dropped as NaN
+    intensity_records = pd.DataFrame(
+        {col: pd.to_numeric(chunk[col], errors="coerce") for col in sample_cols},
+        index=chunk.index,
+        dtype="float64"
+    ).to_dict(orient="records")
+    
+    # NaN is the only value not equal to itself, so `v == v` drops missing intensities
+    return [
+        {
+            "name": names[i],
+            "mz": mz[i],
+            "mzmin": mzmin[i],
+            "mzmax": mzmax[i],
+            "rt": rt[i],
+            "rtmin": rtmin[i],
+            "rtmax": rtmax[i],
+            "npeaks": npeaks[i],
+            "intensities": {k: v for k, v in intensity_records[i].items() if v == v}
+        }
+        for i in range(n_rows)
+    ]
+
+
+def _iter_csv_chunks(
+    csv_path: Path,
+    columns: List[str],
+    usecols: List[str],
+    dtype: Dict[str, Any],
+    chunksize: int,
+    use_pyarrow: bool
+) -> Iterator[pd.DataFrame]:
+    """
+    Yield DataFrames of about ``chunksize`` rows from a CSV file.
+    
+    Uses PyArrow's multi-threaded streaming CSV reader if ``use_pyarrow``,
+    and the pandas C parser otherwise. ``columns`` are the header names as
+    pandas reads them (e.g. ``Unnamed: 0`` for an empty header cell, ``.1``
+    suffixes on duplicates) and are given to PyArrow so both readers agree.
+    """
+    if not use_pyarrow:
+        yield from pd.read_csv(csv_path, usecols=usecols, dtype=dtype, chunksize=chunksize)
+        return
+    
+    column_types = {
+        col: pa.string() if col_type is str else pa.float64()
+        for col, col_type in dtype.items()
+    }
+    reader = pa_csv.open_csv(
+        str(csv_path),
+        read_options=pa_csv.ReadOptions(column_names=columns, skip_rows=1),
+        convert_options=pa_csv.ConvertOptions(
+            column_types=column_types,
+            include_columns=usecols
+        )
+    )
+    
+    # PyArrow batches by bytes, so regroup them into chunks of ~chunksize rows
+    pending = []
+    pending_rows = 0
+    for batch in reader:
+        pending.append(batch)
+        pending_rows += batch.num_rows
+        if pending_rows >= chunksize:
+            yield pa.Table.from_batches(pending).to_pandas()
+            pending = []
+            pending_rows = 0
+    if pending:
+        yield pa.Table.from_batches(pending).to_pandas()
+
+
+def _read_peak_table(
+    csv_path: Path,
+    columns: List[str],
+    chunksize: int,
+    use_pyarrow: bool
+) -> PeakTable:
+    """Parse an XCMS peak table chunk by chunk into a PeakTable."""
+    # Extract intensity values for each sample
+    sample_cols = [col for col in columns if col not in XCMS_META_COLUMNS]
+    usecols = [col for col in columns if col != "."]
+    dtype = {
+        col: str if col == "name" else "float64"
+        for col in usecols if col in XCMS_META_COLUMNS
+    }
+    
+    peaks = []
+    mz_parts = []
+    rt_parts = []
+    for chunk in _iter_csv_chunks(csv_path, columns, usecols, dtype, chunksize, use_pyarrow):
+        peaks.extend(_chunk_to_records(chunk, sample_cols))
+        mz_parts.append(_numeric_column(chunk, "mz", np.float32))
+        rt_parts.append(_numeric_column(chunk, "rt", np.float32))
+    
+    return PeakTable(
+        peaks=peaks,
+        mz=np.concatenate(mz_parts) if mz_parts else np.zeros(0, dtype=np.float32),
+        rt=np.concatenate(rt_parts) if rt_parts else np.zeros(0, dtype=np.float32)
+    )
+
+
+def load_xcms_data(csv_path: Path, chunksize: int = XCMS_CSV_CHUNK_ROWS) -> PeakTable:
     """
     Load XCMS PeakTable CSV file.
     
+    The table is read in chunks of ``chunksize`` rows so that only one chunk
+    of the parsed DataFrame is resident at a time.
+    
     Args:
         csv_path: Path to the XCMS PeakTable CSV file
+        chunksize: Number of rows parsed per chunk
         
     Returns:
-        List of dictionaries containing peak information
+        PeakTable containing peak information
     """
     try:
-        df = pd.read_csv(csv_path)
+        # Scan the header once to fix column selection and dtypes up front,
+        # so the parser does not have to infer them again for every chunk
+        columns = list(pd.read_csv(csv_path, nrows=0).columns)
         
-        # Convert to list of dictionaries
-        peaks = []
-        for _, row in df.iterrows():
-            peak_data = {
-                "name": str(row.get("name", "")),
-                "mz": float(row.get("mz", 0.0)),
-                "mzmin": float(row.get("mzmin", 0.0)),
-                "mzmax": float(row.get("mzmax", 0.0)),
-                "rt": float(row.get("rt", 0.0)),
-                "rtmin": float(row.get("rtmin", 0.0)),
-                "rtmax": float(row.get("rtmax", 0.0)),
-                "npeaks": int(row.get("npeaks", 0)),
-                "intensities": {}
-            }
-            
-            # Extract intensity values for each sample
-            # Skip metadata columns
-            skip_cols = {"name", "mz", "mzmin", "mzmax", "rt", "rtmin", "rtmax", "npeaks", "."}
-            for col in df.columns:
-                if col not in skip_cols:
-                    value = row.get(col)
-                    if pd.notna(value):
-                        try:
-                            peak_data["intensities"][col] = float(value)
-                        except (ValueError, TypeError):
-                            pass
-            
-            peaks.append(peak_data)
-        
-        return peaks
+        if PYARROW_AVAILABLE:
+            try:
+                return _read_peak_table(csv_path, columns, chunksize, use_pyarrow=True)
+            except pa.ArrowInvalid as e:
+                # e.g. a sample column whose inferred type changes after the first block
+                print(f"PyArrow could not parse {csv_path}, falling back to pandas: {str(e)}")
+        return _read_peak_table(csv_path, columns, chunksize, use_pyarrow=False)
     except Exception as e:
         raise ValueError(f"Error loading XCMS data: {str(e)}")
 
@@ -63,27 +256,29 @@ def load_sample_info(csv_path: Path) -> Dict[str, str]:
     """
     try:
         df = pd.read_csv(csv_path)
-        sample_info = {}
-        for _, row in df.iterrows():
-            sample_name = str(row.get("sample.name", ""))
-            group = str(row.get("group", ""))
-            sample_info[sample_name] = group
-        return sample_info
+        if "sample.name" not in df.columns:
+            raise ValueError("missing 'sample.name' column")
+        groups = df["group"].astype(str) if "group" in df.columns else pd.Series("", index=df.index)
+        return dict(zip(df["sample.name"].astype(str).to_numpy(), groups.to_numpy()))
     except Exception as e:
         raise ValueError(f"Error loading sample info: {str(e)}")
 
 
-def get_peak_info(peaks: List[Dict[str, Any]], peak_name: str) -> Optional[Dict[str, Any]]:
+def get_peak_info(peaks: PeaksLike, peak_name: str) -> Optional[Dict[str, Any]]:
     """
     Get information for a specific peak by name.
     
     Args:
-        peaks: List of peak dictionaries
+        peaks: PeakTable or list of peak dictionaries
         peak_name: Name of the peak to retrieve
         
     Returns:
         Peak dictionary or None if not found
     """
+    if isinstance(peaks, PeakTable):
+        return peaks.by_name.get(peak_name)
+    
+    # Building a PeakTable for a single lookup would cost more than a scan
     for peak in peaks:
         if peak.get("name") == peak_name:
             return peak
@@ -91,7 +286,7 @@ def get_peak_info(peaks: List[Dict[str, Any]], peak_name: str) -> Optional[Dict[
 
 
 def filter_peaks(
-    peaks: List[Dict[str, Any]],
+    peaks: PeaksLike,
     mz_min: Optional[float] = None,
     mz_max: Optional[float] = None,
     rt_min: Optional[float] = None,
@@ -101,7 +296,7 @@ def filter_peaks(
     Filter peaks by m/z and retention time ranges.
     
     Args:
-        peaks: List of peak dictionaries
+        peaks: PeakTable or list of peak dictionaries
         mz_min: Minimum m/z value
         mz_max: Maximum m/z value
         rt_min: Minimum retention time
@@ -110,16 +305,32 @@ def filter_peaks(
     Returns:
         Filtered list of peaks
     """
-    filtered = peaks
+    if not isinstance(peaks, PeakTable):
+        # One pass over a plain list; building a PeakTable would sort it first
+        return [
+            p for p in peaks
+            if (mz_min is None or p.get("mz", 0) >= mz_min)
+            and (mz_max is None or p.get("mz", 0) <= mz_max)
+            and (rt_min is None or p.get("rt", 0) >= rt_min)
+            and (rt_max is None or p.get("rt", 0) <= rt_max)
+        ]
     
-    if mz_min is not None:
-        filtered = [p for p in filtered if p.get("mz", 0) >= mz_min]
-    if mz_max is not None:
-        filtered = [p for p in filtered if p.get("mz", 0) <= mz_max]
+    table = peaks
+    
+    # Narrow by m/z with a binary search, then apply the RT bounds to the survivors
+    if mz_min is not None or mz_max is not None:
+        indices = np.sort(query_mz_window(
+            table,
+            -np.inf if mz_min is None else mz_min,
+            np.inf if mz_max is None else mz_max
+        ))
+    else:
+        indices = np.arange(len(table))
+    
+    mask = np.ones(len(indices), dtype=bool)
     if rt_min is not None:
-        filtered = [p for p in filtered if p.get("rt", 0) >= rt_min]
+        mask &= table.rt[indices] >= rt_min
     if rt_max is not None:
-        filtered = [p for p in filtered if p.get("rt", 0) <= rt_max]
+        mask &= table.rt[indices] <= rt_max
     
-    return filtered
-
+    return [table.peaks[i] for i in indices[mask]]
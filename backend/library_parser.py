@@ -3,33 +3,188 @@ from pathlib import Path
 from typing import List, Dict, Any, Optional
 from matchms import importing
 from matchms import Spectrum
+import numpy as np
+import pandas as pd
+import gzip
+import hashlib
 import json
+import os
+import shutil
+import tempfile
+from backend.config import LIBRARY_CACHE_DIR
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
-def parse_library_file(file_path: Path) -> List[Spectrum]:
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Bumped whenever the cache layout changes, so older caches are not reused
+LIBRARY_CACHE_VERSION = 2
+
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+
+def parse_library_file(file_path: Path, use_cache: bool = True) -> List[Spectrum]:
     """
     Parse spectral library file in various formats.
     
-    Supported formats: MSP, MGF, JSON, mzML
+    Supported formats: MSP, MGF, JSON, mzML. JSON libraries may also be
+    gzip- or zstd-compressed (.json.gz, .json.zst).
+    
+    The first parse of a file is written to a binary cache (see
+    save_library_cache); later calls load the cache instead of re-parsing.
     
     Args:
         file_path: Path to library file
+        use_cache: Whether to read and write the binary library cache
         
     Returns:
         List of matchms Spectrum objects
     """
     file_extension = file_path.suffix.lower()
+    if file_extension in (".gz", ".zst") and len(file_path.suffixes) > 1:
+        file_extension = "".join(s.lower() for s in file_path.suffixes[-2:])
+    
+    cache_path = _cache_path(file_path) if use_cache else None
+    if cache_path is not None and cache_path.exists():
+        try:
+            return load_library_cache(cache_path)
+        except Exception as e:
+            print(f"Warning: Could not load library cache {cache_path}: {e}")
+            # Remove the broken cache so it is rewritten below
+            shutil.rmtree(cache_path, ignore_errors=True)
     
     if file_extension == ".msp":
-        return parse_msp_file(file_path)
+        spectra = parse_msp_file(file_path)
     elif file_extension == ".mgf":
-        return parse_mgf_file(file_path)
-    elif file_extension == ".json":
-        return parse_json_file(file_path)
+        spectra = parse_mgf_file(file_path)
+    elif file_extension in [".json", ".json.gz", ".json.zst"]:
+        spectra = parse_json_file(file_path)
     elif file_extension in [".mzml", ".mzxml"]:
-        return parse_mzml_file(file_path)
+        spectra = parse_mzml_file(file_path)
     else:
         raise ValueError(f"Unsupported file format: {file_extension}")
+    
+    if cache_path is not None:
+        try:
+            save_library_cache(spectra, cache_path)
+        except Exception as e:
+            print(f"Warning: Could not write library cache {cache_path}: {e}")
+    
+    return spectra
+
+
+def library_file_key(file_path: Path) -> str:
+    """
+    Identify a library file by resolved path, size and mtime without reading it.
+    
+    Args:
+        file_path: Path to the library file
+        
+    Returns:
+        Hex digest that changes whenever the file is replaced or modified
+    """
+    stat = file_path.stat()
+    key = f"{file_path.resolve()}:{stat.st_size}:{stat.st_mtime_ns}"
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+
+def _cache_path(file_path: Path) -> Path:
+    """Get the cache directory for a library file, keyed by path, size, mtime and cache version."""
+    stat = file_path.stat()
+    key = f"v{LIBRARY_CACHE_VERSION}:{file_path.resolve()}:{stat.st_size}:{stat.st_mtime_ns}"
+    return LIBRARY_CACHE_DIR / hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+
+def _json_default(value: Any) -> Any:
+    """Convert NumPy scalars and arrays in spectrum metadata to JSON types."""
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    return str(value)
+
+
+def save_library_cache(spectra: List[Spectrum], cache_path: Path) -> None:
+    """
+    Write spectra to a binary columnar cache.
+    
+    Peaks of all spectra are concatenated into contiguous ``mz.npy`` and
+    ``intensities.npy`` arrays in the dtype the parser produced, so cached
+    and freshly parsed libraries score identically; ``offsets.npy`` holds the start of each
+    spectrum (plus a final end offset) and ``metadata.json`` the metadata.
+    
+    Args:
+        spectra: List of matchms Spectrum objects
+        cache_path: Cache directory to create
+    """
+    sizes = [len(s.peaks.mz) for s in spectra]
+    offsets = np.zeros(len(spectra) + 1, dtype=np.int64)
+    np.cumsum(sizes, out=offsets[1:])
+    
+    if spectra:
+        mz = np.concatenate([s.peaks.mz for s in spectra])
+        intensities = np.concatenate([s.peaks.intensities for s in spectra])
+    else:
+        mz = np.zeros(0, dtype=np.float64)
+        intensities = np.zeros(0, dtype=np.float64)
+    
+    # Write into a uniquely named temporary directory and rename it into place,
+    # so readers never see a partial cache and concurrent writers do not clash
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = Path(tempfile.mkdtemp(prefix=cache_path.name + ".", dir=cache_path.parent))
+    try:
+        np.save(tmp_path / "mz.npy", mz)
+        np.save(tmp_path / "intensities.npy", intensities)
+        np.save(tmp_path / "offsets.npy", offsets)
+        with open(tmp_path / "metadata.json", 'w', encoding='utf-8') as f:
+            json.dump([s.metadata for s in spectra], f, default=_json_default)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        # Another process finished writing the same cache first
+        if not cache_path.exists():
+            raise
+    except BaseException:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        raise
+
+
+def load_library_cache(cache_path: Path) -> List[Spectrum]:
+    """
+    Load spectra from a cache written by save_library_cache.
+    
+    The peak arrays are memory-mapped, so each Spectrum only holds views
+    into the cache files rather than copies.
+    
+    Args:
+        cache_path: Cache directory
+        
+    Returns:
+        List of matchms Spectrum objects
+    """
+    mz = np.load(cache_path / "mz.npy", mmap_mode="r")
+    intensities = np.load(cache_path / "intensities.npy", mmap_mode="r")
+    offsets = np.load(cache_path / "offsets.npy")
+    with open(cache_path / "metadata.json", 'r', encoding='utf-8') as f:
+        metadata = json.load(f)
+    
+    # Metadata was harmonized when the library was first parsed
+    return [
+        Spectrum(
+            mz=mz[start:end],
+            intensities=intensities[start:end],
+            metadata=meta,
+            metadata_harmonization=False
+        )
+        for start, end, meta in zip(offsets[:-1], offsets[1:], metadata)
+    ]
 
 
 def parse_msp_file(file_path: Path) -> List[Spectrum]:
@@ -50,11 +205,28 @@ def parse_mgf_file(file_path: Path) -> List[Spectrum]:
         raise ValueError(f"Error parsing MGF file: {str(e)}")
 
 
+def _read_maybe_compressed(file_path: Path) -> bytes:
+    """Read a file, transparently decompressing gzip or zstd content."""
+    with open(file_path, 'rb') as f:
+        magic = f.read(4)
+    
+    if magic.startswith(GZIP_MAGIC):
+        with gzip.open(file_path, 'rb') as f:
+            return f.read()
+    if magic == ZSTD_MAGIC:
+        if zstandard is None:
+            raise ValueError("zstd-compressed files require the zstandard package")
+        with open(file_path, 'rb') as f:
+            with zstandard.ZstdDecompressor().stream_reader(f) as reader:
+                return reader.read()
+    return file_path.read_bytes()
+
+
 def parse_json_file(file_path: Path) -> List[Spectrum]:
-    """Parse JSON format library file."""
+    """Parse JSON format library file (optionally gzip- or zstd-compressed)."""
     try:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            data = json.load(f)
+        raw = _read_maybe_compressed(file_path)
+        data = orjson.loads(raw) if orjson is not None else json.loads(raw)
         
         spectra = []
         if isinstance(data, list):
@@ -84,8 +256,8 @@ def parse_json_spectrum(data: Dict[str, Any]) -> Optional[Spectrum]:
         metadata = data.get("metadata", {})
         
         spectrum = Spectrum(
-            mz=mz,
-            intensities=intensities,
+            mz=np.asarray(mz, dtype=np.float32),
+            intensities=np.asarray(intensities, dtype=np.float32),
             metadata=metadata
         )
         
@@ -122,30 +294,25 @@ def get_library_info(spectra: List[Spectrum]) -> Dict[str, Any]:
             "formats": []
         }
     
-    compounds = []
-    precursor_mzs = []
-    
-    for spectrum in spectra:
-        # Get compound name
-        compound_name = spectrum.get("compound_name") or \
-                       spectrum.get("name") or \
-                       spectrum.get("title", "Unknown")
-        compounds.append(compound_name)
-        
-        # Get precursor m/z
-        precursor_mz = spectrum.get("precursor_mz")
-        if precursor_mz:
-            precursor_mzs.append(float(precursor_mz))
+    compounds = [
+        spectrum.get("compound_name") or spectrum.get("name") or spectrum.get("title", "Unknown")
+        for spectrum in spectra
+    ]
+    precursor_mzs = np.fromiter(
+        (float(spectrum.get("precursor_mz") or np.nan) for spectrum in spectra),
+        dtype=np.float64,
+        count=len(spectra)
+    )
+    has_precursor = not np.isnan(precursor_mzs).all()
     
     info = {
         "count": len(spectra),
-        "compounds": list(set(compounds)),
+        "compounds": pd.unique(np.asarray(compounds, dtype=object)).tolist(),
         "precursor_mz_range": {
-            "min": min(precursor_mzs) if precursor_mzs else None,
-            "max": max(precursor_mzs) if precursor_mzs else None
+            "min": float(np.nanmin(precursor_mzs)) if has_precursor else None,
+            "max": float(np.nanmax(precursor_mzs)) if has_precursor else None
         },
         "formats": ["matchms"]
     }
     
     return info
-
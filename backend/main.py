@@ -4,20 +4,24 @@ from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import FileResponse, JSONResponse
 from fastapi.staticfiles import StaticFiles
 import uvicorn
+import aiofiles
 from pathlib import Path
 import json
 import asyncio
-from typing import List, Optional, Dict, Any
+import functools
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional, Dict, Any, Tuple, Callable, Set
 
-from backend.config import UPLOAD_DIR, RESULTS_DIR
+from backend.config import UPLOAD_DIR, RESULTS_DIR, UPLOAD_CHUNK_SIZE, MS2QUERY_CACHE_DIR
 from backend.models import (
     MatchingConfig, MS2ExtractionConfig, ProcessingStatus,
     XCMSProcessingConfig, XCMSProcessingResult
 )
-from backend.data_loader import load_xcms_data, get_peak_info
-from backend.ms2_extractor import extract_ms2_spectra
-from backend.library_parser import parse_library_file
-from backend.ms2query_matcher import match_with_ms2query, is_ms2query_available
+from backend.data_loader import load_xcms_data
+from backend.ms2_extractor import extract_ms2_spectra, spectrum_to_dict
+from backend.library_parser import parse_library_file, library_file_key
+from backend.ms2query_matcher import match_with_ms2query, is_ms2query_available, build_ms2query_index
 from backend.spectral_matcher import match_with_traditional
 from backend.results_processor import process_matching_results
 from backend.xcms_processor import (
@@ -26,6 +30,7 @@ from backend.xcms_processor import (
     load_xcms_params_from_yaml, validate_xcms_params
 )
 from backend.errors import MS2ExtractionError, LibraryParseError, MatchingError, XCMSProcessingError
+from backend.utils import advise_will_need, worker_mp_context
 
 app = FastAPI(title="XCMS Metabolite MS2 Matching Tool", version="1.0.0")
 
@@ -39,7 +44,156 @@ app.add_middleware(
 )
 
 # Store active WebSocket connections
-active_connections: List[WebSocket] = []
+active_connections: Set[WebSocket] = set()
+
+# Worker processes for CPU-bound parsing and matching, so it does not block the event loop;
+# started without fork (see worker_mp_context) since the server process is multi-threaded
+PARSER_POOL = ProcessPoolExecutor(max_workers=os.cpu_count(), mp_context=worker_mp_context())
+
+
+@app.on_event("shutdown")
+def shutdown_parser_pool():
+    """Stop the worker processes when the server shuts down."""
+    PARSER_POOL.shutdown(wait=False, cancel_futures=True)
+
+
+async def run_in_pool(fn: Callable[..., Any], *args, **kwargs) -> Any:
+    """Run a CPU-bound function in PARSER_POOL and await its result."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(PARSER_POOL, functools.partial(fn, *args, **kwargs))
+
+
+# MS2Query library builds, keyed by library_file_key of the uploaded library file
+ms2query_index_builds: Dict[str, asyncio.Task] = {}
+
+
+async def _build_ms2query_index(file_key: str, file_path: Path) -> Optional[Path]:
+    """
+    Build the MS2Query library for an uploaded library file, reporting progress.
+    
+    Returns None if the build failed. The failed task is unregistered so a
+    later request retries the build (e.g. after a failed model download).
+    """
+    job_id = f"ms2query_index_{file_key}"
+    await broadcast_progress(job_id, "processing", 0.0, f"Building MS2Query library for {file_path.name}")
+    try:
+        index_dir = await run_in_pool(build_ms2query_index, file_path, MS2QUERY_CACHE_DIR)
+    except Exception as e:
+        print(f"MS2Query library build failed for {file_path.name}: {str(e)}")
+        ms2query_index_builds.pop(file_key, None)
+        await broadcast_progress(job_id, "error", 0.0, str(e))
+        return None
+    await broadcast_progress(job_id, "completed", 1.0, f"MS2Query library ready for {file_path.name}")
+    return index_dir
+
+
+async def get_ms2query_index(file_path: Path) -> asyncio.Task:
+    """Return the MS2Query library build task for a library file, starting it if needed."""
+    file_key = library_file_key(file_path)
+    task = ms2query_index_builds.get(file_key)
+    if task is None:
+        task = asyncio.create_task(_build_ms2query_index(file_key, file_path))
+        ms2query_index_builds[file_key] = task
+    return task
+
+
+def _count_library_spectra(file_path: Path) -> int:
+    """Parse a library (building its cache) and return only the spectrum count."""
+    library_data = parse_library_file(file_path)
+    return len(library_data) if isinstance(library_data, list) else 1
+
+
+def _run_matching_workflow(
+    mzxml_path: Path,
+    xcms_path: Path,
+    library_path: Path,
+    algorithm: str,
+    config: MatchingConfig,
+    ms2query_index_dir: Optional[Path],
+    ms2query_error: Optional[str]
+) -> Dict[str, Any]:
+    """
+    Extract, match and process spectra in one worker process.
+    
+    Only paths and parameters are sent to the worker and only plain result
+    dictionaries come back, so spectra, the library and the peak table are
+    never pickled between processes.
+    
+    Args:
+        mzxml_path: Path to the mzXML file
+        xcms_path: Path to the XCMS peak table
+        library_path: Path to the spectral library file
+        algorithm: Matching algorithm
+        config: Matching configuration
+        ms2query_index_dir: Ready MS2Query library directory, if any
+        ms2query_error: Why MS2Query cannot be used, if it cannot
+        
+    Returns:
+        Dictionary with "extraction" and "matching" sections
+    """
+    # Step 1: Extract MS2 spectra
+    extraction_config = MS2ExtractionConfig(
+        mz_tolerance=config.mz_tolerance,
+        rt_tolerance=config.rt_tolerance
+    )
+    query_spectra = extract_ms2_spectra(
+        mzxml_path,
+        xcms_path,
+        mz_tolerance=extraction_config.mz_tolerance,
+        rt_tolerance=extraction_config.rt_tolerance,
+        min_intensity=extraction_config.min_intensity
+    )
+    
+    # Step 2: Load library
+    library_spectra = parse_library_file(library_path)
+    
+    # Step 3: Perform matching
+    matching_results = None
+    if algorithm == "ms2query":
+        try:
+            if ms2query_index_dir is None:
+                raise ValueError(ms2query_error or "MS2Query library not available")
+            matching_results = match_with_ms2query(
+                query_spectra,
+                library_path=ms2query_index_dir,
+                analog_search=True,
+                top_n=config.top_n
+            )
+        except Exception as e:
+            # Fallback to traditional if MS2Query fails
+            print(f"MS2Query failed ({str(e)}), using traditional matching")
+            algorithm = "cosine"  # Update algorithm name for results
+    
+    if matching_results is None:
+        matching_results = match_with_traditional(
+            query_spectra,
+            library_spectra,
+            algorithm=algorithm,
+            mz_tolerance=config.mz_tolerance,
+            min_score=config.min_score,
+            top_n=config.top_n,
+            precursor_tolerance_ppm=config.precursor_tolerance_ppm
+        )
+    
+    # Step 4: Process results
+    xcms_peaks = load_xcms_data(xcms_path)
+    processed_results = process_matching_results(
+        xcms_peaks,
+        matching_results,
+        algorithm=algorithm
+    )
+    
+    return {
+        "extraction": {
+            "spectra_count": len(query_spectra),
+            "spectra": [spectrum_to_dict(s) for s in query_spectra]
+        },
+        "matching": {
+            "algorithm": algorithm,
+            "matches": matching_results,
+            "processed_results": processed_results
+        }
+    }
 
 
 async def broadcast_progress(job_id: str, status: str, progress: float, message: str = None):
@@ -50,14 +204,26 @@ async def broadcast_progress(job_id: str, status: str, progress: float, message:
         "progress": progress,
         "message": message
     }
-    disconnected = []
-    for connection in active_connections:
-        try:
-            await connection.send_json(data)
-        except:
-            disconnected.append(connection)
-    for conn in disconnected:
-        active_connections.remove(conn)
+    # Send to all clients concurrently so one slow client does not delay the others
+    connections = list(active_connections)
+    results = await asyncio.gather(
+        *(connection.send_json(data) for connection in connections),
+        return_exceptions=True
+    )
+    active_connections.difference_update(
+        conn for conn, result in zip(connections, results) if isinstance(result, Exception)
+    )
+
+
+async def _save_upload(file: UploadFile, prefix: str) -> Tuple[Path, int]:
+    """Stream an uploaded file to UPLOAD_DIR in chunks and return its path and size."""
+    file_path = UPLOAD_DIR / f"{prefix}_{file.filename}"
+    size = 0
+    async with aiofiles.open(file_path, "wb") as out:
+        while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+            await out.write(chunk)
+            size += len(chunk)
+    return file_path, size
 
 
 @app.get("/")
@@ -76,15 +242,12 @@ async def health_check():
 async def upload_xcms_results(file: UploadFile = File(...)):
     """Upload XCMS results CSV file."""
     try:
-        file_path = UPLOAD_DIR / f"xcms_{file.filename}"
-        with open(file_path, "wb") as f:
-            content = await file.read()
-            f.write(content)
+        file_path, size = await _save_upload(file, "xcms")
         
         return {
             "filename": file.filename,
             "path": str(file_path),
-            "size": len(content)
+            "size": size
         }
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -94,15 +257,12 @@ async def upload_xcms_results(file: UploadFile = File(...)):
 async def upload_mzxml(file: UploadFile = File(...)):
     """Upload mzXML file."""
     try:
-        file_path = UPLOAD_DIR / f"mzxml_{file.filename}"
-        with open(file_path, "wb") as f:
-            content = await file.read()
-            f.write(content)
+        file_path, size = await _save_upload(file, "mzxml")
         
         return {
             "filename": file.filename,
             "path": str(file_path),
-            "size": len(content)
+            "size": size
         }
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -112,26 +272,31 @@ async def upload_mzxml(file: UploadFile = File(...)):
 async def upload_library(file: UploadFile = File(...)):
     """Upload spectral library file."""
     try:
-        file_path = UPLOAD_DIR / f"library_{file.filename}"
-        with open(file_path, "wb") as f:
-            content = await file.read()
-            f.write(content)
+        file_path, size = await _save_upload(file, "library")
         
         # Try to parse the library to validate
         try:
-            library_data = parse_library_file(file_path)
+            # The file was just written, so keep it in the page cache for parsing
+            advise_will_need(file_path)
+            spectra_count = await run_in_pool(_count_library_spectra, file_path)
+            
+            # Start building the MS2Query library in the background so
+            # matching requests do not have to build it
+            if is_ms2query_available():
+                await get_ms2query_index(file_path)
+            
             return {
                 "filename": file.filename,
                 "path": str(file_path),
-                "size": len(content),
-                "spectra_count": len(library_data) if isinstance(library_data, list) else 1,
+                "size": size,
+                "spectra_count": spectra_count,
                 "valid": True
             }
         except Exception as parse_error:
             return {
                 "filename": file.filename,
                 "path": str(file_path),
-                "size": len(content),
+                "size": size,
                 "valid": False,
                 "error": str(parse_error)
             }
@@ -152,8 +317,8 @@ async def get_xcms_peaks(xcms_file: str):
         if not file_path.exists():
             raise HTTPException(status_code=404, detail="XCMS file not found")
         
-        data = load_xcms_data(file_path)
-        return {"peaks": data}
+        data = await run_in_pool(load_xcms_data, file_path)
+        return {"peaks": data.peaks}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -174,7 +339,8 @@ async def extract_ms2(
         if not xcms_path.exists():
             raise HTTPException(status_code=404, detail="XCMS file not found")
         
-        spectra = extract_ms2_spectra(
+        spectra = await run_in_pool(
+            extract_ms2_spectra,
             mzxml_path,
             xcms_path,
             mz_tolerance=config.mz_tolerance,
@@ -182,7 +348,7 @@ async def extract_ms2(
             min_intensity=config.min_intensity
         )
         
-        return {"spectra_count": len(spectra), "spectra": spectra}
+        return {"spectra_count": len(spectra), "spectra": [spectrum_to_dict(s) for s in spectra]}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -221,79 +387,38 @@ async def match_spectra(request_data: Dict[str, Any] = Body(...)):
         if not library_path.exists():
             raise HTTPException(status_code=404, detail="Library file not found")
         
-        # Step 1: Extract MS2 spectra
-        extraction_config = MS2ExtractionConfig(
-            mz_tolerance=config.mz_tolerance,
-            rt_tolerance=config.rt_tolerance
-        )
-        ms2_spectra_data = extract_ms2_spectra(
-            mzxml_path,
-            xcms_path,
-            mz_tolerance=extraction_config.mz_tolerance,
-            rt_tolerance=extraction_config.rt_tolerance,
-            min_intensity=extraction_config.min_intensity
-        )
-        
-        # Convert to matchms Spectrum objects
-        from backend.ms2_extractor import convert_to_matchms_spectrum
-        query_spectra = [convert_to_matchms_spectrum(s) for s in ms2_spectra_data]
-        
-        # Step 2: Load library
-        library_spectra = parse_library_file(library_path)
-        
-        # Step 3: Perform matching
+        # Decide here whether the MS2Query library is ready; the rest of the
+        # workflow runs in one worker so spectra and peaks never cross processes
+        ms2query_index_dir = None
+        ms2query_error = None
         if algorithm == "ms2query":
             try:
-                from backend.ms2query_matcher import is_ms2query_available
-                if is_ms2query_available():
-                    matching_results = match_with_ms2query(
-                        query_spectra,
-                        library_path=library_path.parent,
-                        analog_search=True,
-                        top_n=config.top_n
-                    )
-                else:
+                if not is_ms2query_available():
                     raise ImportError("MS2Query not available")
-            except (ImportError, ValueError, Exception) as e:
-                # Fallback to traditional if MS2Query fails
-                print(f"MS2Query failed ({str(e)}), using traditional matching")
-                matching_results = match_with_traditional(
-                    query_spectra,
-                    library_spectra,
-                    algorithm="cosine",
-                    mz_tolerance=config.mz_tolerance,
-                    min_score=config.min_score,
-                    top_n=config.top_n
-                )
-                algorithm = "cosine"  # Update algorithm name for results
-        else:
-            matching_results = match_with_traditional(
-                query_spectra,
-                library_spectra,
-                algorithm=algorithm,
-                mz_tolerance=config.mz_tolerance,
-                min_score=config.min_score,
-                top_n=config.top_n
-            )
+                # Never wait for a build in progress; match traditionally until it is ready
+                index_task = await get_ms2query_index(library_path)
+                if not index_task.done():
+                    raise RuntimeError("MS2Query library is still being built")
+                ms2query_index_dir = index_task.result()
+                if ms2query_index_dir is None:
+                    raise ValueError("MS2Query library build failed")
+            except Exception as e:
+                ms2query_error = str(e)
         
-        # Step 4: Process results
-        xcms_peaks = load_xcms_data(xcms_path)
-        processed_results = process_matching_results(
-            xcms_peaks,
-            matching_results,
-            algorithm=algorithm
+        workflow = await run_in_pool(
+            _run_matching_workflow,
+            mzxml_path,
+            xcms_path,
+            library_path,
+            algorithm,
+            config,
+            ms2query_index_dir,
+            ms2query_error
         )
         
         return {
-            "extraction": {
-                "spectra_count": len(ms2_spectra_data),
-                "spectra": ms2_spectra_data
-            },
-            "matching": {
-                "algorithm": algorithm,
-                "matches": matching_results,
-                "processed_results": processed_results
-            },
+            "extraction": workflow["extraction"],
+            "matching": workflow["matching"],
             "config": config.dict()
         }
     except Exception as e:
@@ -304,14 +429,14 @@ async def match_spectra(request_data: Dict[str, Any] = Body(...)):
 async def websocket_progress(websocket: WebSocket):
     """WebSocket endpoint for progress updates."""
     await websocket.accept()
-    active_connections.append(websocket)
+    active_connections.add(websocket)
     try:
         while True:
             data = await websocket.receive_text()
             # Echo back or process client messages
             await websocket.send_json({"received": data})
     except WebSocketDisconnect:
-        active_connections.remove(websocket)
+        active_connections.discard(websocket)
 
 
 # Serve static files in production (uncomment if needed)
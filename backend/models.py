@@ -10,6 +10,9 @@ class MatchingAlgorithm(str, Enum):
     DOT_PRODUCT = "dot_product"
     COSINE = "cosine"
     MODIFIED_COSINE = "modified_cosine"
+    BINNED_COSINE = "binned_cosine"
+    SPARSE_COSINE = "sparse_cosine"
+    GPU_COSINE = "gpu_cosine"
 
 
 class MatchingConfig(BaseModel):
@@ -19,6 +22,7 @@ class MatchingConfig(BaseModel):
     rt_tolerance: float = Field(default=30.0, ge=1.0, le=300.0)
     min_score: float = Field(default=0.0, ge=0.0, le=1.0)
     top_n: int = Field(default=10, ge=1, le=100)
+    precursor_tolerance_ppm: Optional[float] = Field(default=None, ge=0.1, le=1000.0)
 
 
 class MS2ExtractionConfig(BaseModel):
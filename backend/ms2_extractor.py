@@ -1,10 +1,79 @@
 """Extract MS2 spectra from mzXML files and match to XCMS features."""
+import functools
 import pymzml
 from pathlib import Path
 from typing import List, Dict, Any, Optional, Tuple
 from matchms import Spectrum
 import numpy as np
-from backend.data_loader import load_xcms_data
+from backend.data_loader import (
+    load_xcms_data, as_peak_table, query_mz_window, PeaksLike, PeakTable
+)
+
+try:
+    from numba import njit, prange
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+
+
+@functools.lru_cache(maxsize=4)
+def _read_ms2_scans(
+    path_str: str,
+    size: int,
+    mtime_ns: int
+) -> Tuple[Tuple[float, float, np.ndarray], ...]:
+    """
+    Read the precursor, retention time and raw peaks of every MS2 scan.
+    
+    The file is read in one sequential pass, which also works on files
+    without a spectrum index, and the reader is closed afterwards. Results
+    are cached by path, size and modification time so repeated extractions
+    from the same file skip parsing it again.
+    
+    Args:
+        path_str: Path to the MS data file
+        size: File size in bytes, part of the cache key
+        mtime_ns: File modification time, part of the cache key
+        
+    Returns:
+        Tuple of (precursor m/z, retention time in seconds, read-only
+        float32 peak array of shape (n, 2)) per MS2 scan with precursor info
+    """
+    scans = []
+    run = pymzml.run.Reader(path_str)
+    try:
+        for spectrum in run:
+            if spectrum.ms_level != 2:
+                continue
+            # Get precursor information
+            precursor_mz = None
+            precursor_rt = None
+            
+            # Try to get precursor m/z (newer pymzml lists only the precursor
+            # scan IDs in precursors and the m/z in selected_precursors)
+            precursors = (
+                getattr(spectrum, 'selected_precursors', None)
+                or getattr(spectrum, 'precursors', None)
+                or []
+            )
+            if len(precursors) > 0 and isinstance(precursors[0], dict):
+                precursor_mz = precursors[0].get('mz', None)
+            
+            # Get retention time
+            if hasattr(spectrum, 'scan_time'):
+                precursor_rt = spectrum.scan_time[0] * 60  # Convert to seconds
+            
+            if precursor_mz is None or precursor_rt is None:
+                continue
+            
+            peak_array = np.asarray(spectrum.peaks("raw"), dtype=np.float32).reshape(-1, 2)
+            # Shared between calls through the cache
+            peak_array.flags.writeable = False
+            scans.append((precursor_mz, precursor_rt, peak_array))
+    finally:
+        run.close()
+    
+    return tuple(scans)
 
 
 def extract_ms2_spectra(
@@ -13,10 +82,13 @@ def extract_ms2_spectra(
     mz_tolerance: float = 0.01,
     rt_tolerance: float = 30.0,
     min_intensity: float = 100.0
-) -> List[Dict[str, Any]]:
+) -> List[Spectrum]:
     """
     Extract MS2 spectra from mzXML file and match to XCMS features.
     
+    The peak arrays are passed to matchms as they are; use spectrum_to_dict
+    to serialize the spectra for an API response.
+    
     Args:
         mzxml_path: Path to mzXML file
         xcms_csv_path: Path to XCMS PeakTable CSV
@@ -25,73 +97,162 @@ def extract_ms2_spectra(
         min_intensity: Minimum intensity threshold
         
     Returns:
-        List of dictionaries containing matched MS2 spectra
+        List of matchms Spectrum objects for MS2 scans matched to an XCMS feature
     """
     # Load XCMS peaks
     xcms_peaks = load_xcms_data(xcms_csv_path)
     
-    # Extract MS2 spectra from mzXML
-    ms2_spectra = []
-    run = pymzml.run.Reader(str(mzxml_path))
+    # Collect MS2 scans from mzXML; matching is done afterwards in bulk
+    scan_mzs = []
+    scan_rts = []
+    scan_peaks = []
+    stat = mzxml_path.stat()
     
-    for spectrum in run:
-        if spectrum.ms_level == 2:
-            # Get precursor information
-            precursor_mz = None
-            precursor_rt = None
-            
-            # Try to get precursor m/z
-            if hasattr(spectrum, 'precursors'):
-                if len(spectrum.precursors) > 0:
-                    precursor_mz = spectrum.precursors[0].get('mz', None)
-            
-            # Get retention time
-            if hasattr(spectrum, 'scan_time'):
-                precursor_rt = spectrum.scan_time[0] * 60  # Convert to seconds
-            
-            if precursor_mz is None or precursor_rt is None:
-                continue
-            
-            # Extract peaks
-            peaks = []
-            if hasattr(spectrum, 'peaks'):
-                for mz, intensity in spectrum.peaks:
-                    if intensity >= min_intensity:
-                        peaks.append((float(mz), float(intensity)))
-            
-            if len(peaks) == 0:
-                continue
-            
-            # Match to XCMS features
-            matched_peak = find_matching_xcms_peak(
-                xcms_peaks,
-                precursor_mz,
-                precursor_rt,
-                mz_tolerance,
-                rt_tolerance
-            )
-            
-            if matched_peak:
-                # Convert to matchms Spectrum object
-                mz_array = np.array([p[0] for p in peaks])
-                intensities_array = np.array([p[1] for p in peaks])
-                
-                spectrum_dict = {
-                    "feature_name": matched_peak["name"],
-                    "precursor_mz": precursor_mz,
-                    "rt": precursor_rt,
-                    "mz": mz_array.tolist(),
-                    "intensities": intensities_array.tolist(),
-                    "n_peaks": len(peaks),
-                    "matched_xcms_peak": matched_peak["name"]
-                }
-                ms2_spectra.append(spectrum_dict)
+    for precursor_mz, precursor_rt, peak_array in _read_ms2_scans(
+        str(mzxml_path), stat.st_size, stat.st_mtime_ns
+    ):
+        # Extract peaks above the intensity threshold in one vectorized pass
+        keep = peak_array[:, 1] >= min_intensity
+        mz_array = peak_array[keep, 0]
+        intensities_array = peak_array[keep, 1]
+        
+        if mz_array.size == 0:
+            continue
+        
+        scan_mzs.append(precursor_mz)
+        scan_rts.append(precursor_rt)
+        scan_peaks.append((mz_array, intensities_array))
+    
+    # Match all scans to XCMS features at once
+    matched_indices = match_scans_to_peaks(
+        np.asarray(scan_mzs, dtype=np.float64),
+        np.asarray(scan_rts, dtype=np.float64),
+        xcms_peaks,
+        mz_tolerance,
+        rt_tolerance
+    )
+    
+    ms2_spectra = []
+    for precursor_mz, precursor_rt, (mz_array, intensities_array), peak_index in zip(
+        scan_mzs, scan_rts, scan_peaks, matched_indices
+    ):
+        if peak_index < 0:
+            continue
+        matched_peak = xcms_peaks.peaks[peak_index]
+        metadata = {
+            "precursor_mz": precursor_mz,
+            "retention_time": precursor_rt,
+            "feature_name": matched_peak["name"],
+            "matched_xcms_peak": matched_peak["name"],
+            "charge": 1  # Default, can be updated if available
+        }
+        ms2_spectra.append(Spectrum(
+            mz=mz_array,
+            intensities=intensities_array,
+            metadata=metadata
+        ))
     
     return ms2_spectra
 
 
+def _best_peak_in_window(
+    table: PeakTable,
+    mz: float,
+    rt: float,
+    mz_tolerance: float,
+    rt_tolerance: float
+) -> int:
+    """Return the index of the best-scoring peak within tolerance, or -1."""
+    # Restrict candidates to the m/z window, then score only that slice
+    candidates = query_mz_window(table, mz - mz_tolerance, mz + mz_tolerance)
+    mz_diff = np.abs(table.mz[candidates] - mz)
+    rt_diff = np.abs(table.rt[candidates] - rt)
+    
+    in_window = (mz_diff <= mz_tolerance) & (rt_diff <= rt_tolerance)
+    if not in_window.any():
+        return -1
+    
+    # Score based on combined distance (weighted)
+    score = np.where(in_window, mz_diff / mz_tolerance + rt_diff / rt_tolerance, np.inf)
+    return int(candidates[np.argmin(score)])
+
+
+def _match_scans_kernel(
+    scan_mz: np.ndarray,
+    scan_rt: np.ndarray,
+    peak_mz: np.ndarray,
+    peak_rt: np.ndarray,
+    mz_tolerance: float,
+    rt_tolerance: float,
+    out_idx: np.ndarray
+) -> None:
+    """Write the sorted position of the best peak for every scan into ``out_idx`` (-1 if none)."""
+    for i in prange(scan_mz.shape[0]):
+        lo = np.searchsorted(peak_mz, scan_mz[i] - mz_tolerance, side="left")
+        hi = np.searchsorted(peak_mz, scan_mz[i] + mz_tolerance, side="right")
+        best = -1
+        best_score = np.inf
+        for j in range(lo, hi):
+            mz_diff = abs(peak_mz[j] - scan_mz[i])
+            rt_diff = abs(peak_rt[j] - scan_rt[i])
+            if mz_diff <= mz_tolerance and rt_diff <= rt_tolerance:
+                score = mz_diff / mz_tolerance + rt_diff / rt_tolerance
+                if score < best_score:
+                    best_score = score
+                    best = j
+        out_idx[i] = best
+
+
+if NUMBA_AVAILABLE:
+    _match_scans_kernel = njit(parallel=True, cache=True)(_match_scans_kernel)
+
+
+def match_scans_to_peaks(
+    scan_mz: np.ndarray,
+    scan_rt: np.ndarray,
+    xcms_peaks: PeaksLike,
+    mz_tolerance: float,
+    rt_tolerance: float
+) -> np.ndarray:
+    """
+    Match many MS2 scans to XCMS peaks at once.
+    
+    Uses a parallel Numba kernel when Numba is installed and a per-scan
+    NumPy search otherwise.
+    
+    Args:
+        scan_mz: Precursor m/z of each scan
+        scan_rt: Retention time of each scan in seconds
+        xcms_peaks: PeakTable or list of XCMS peak dictionaries
+        mz_tolerance: m/z tolerance (Da)
+        rt_tolerance: RT tolerance (seconds)
+        
+    Returns:
+        Array with the index of the matched peak in the peak list for each
+        scan, or -1 where no peak matches
+    """
+    table = as_peak_table(xcms_peaks)
+    
+    if not NUMBA_AVAILABLE:
+        return np.array([
+            _best_peak_in_window(table, scan_mz[i], scan_rt[i], mz_tolerance, rt_tolerance)
+            for i in range(len(scan_mz))
+        ], dtype=np.int64)
+    
+    positions = np.full(len(scan_mz), -1, dtype=np.int64)
+    _match_scans_kernel(
+        scan_mz, scan_rt, table.mz_sorted, table.rt_by_mz,
+        float(mz_tolerance), float(rt_tolerance), positions
+    )
+    
+    # The kernel works on m/z-sorted positions; map them back to peak indices
+    matched = positions >= 0
+    positions[matched] = table.mz_order[positions[matched]]
+    return positions
+
+
 def find_matching_xcms_peak(
-    xcms_peaks: List[Dict[str, Any]],
+    xcms_peaks: PeaksLike,
     mz: float,
     rt: float,
     mz_tolerance: float,
@@ -101,7 +262,7 @@ def find_matching_xcms_peak(
     Find XCMS peak that matches given m/z and RT.
     
     Args:
-        xcms_peaks: List of XCMS peak dictionaries
+        xcms_peaks: PeakTable or list of XCMS peak dictionaries
         mz: Precursor m/z
         rt: Retention time in seconds
         mz_tolerance: m/z tolerance (Da)
@@ -110,24 +271,30 @@ def find_matching_xcms_peak(
     Returns:
         Matching XCMS peak dictionary or None
     """
-    best_match = None
-    best_score = float('inf')
+    table = as_peak_table(xcms_peaks)
+    index = _best_peak_in_window(table, mz, rt, mz_tolerance, rt_tolerance)
+    return table.peaks[index] if index >= 0 else None
+
+
+def spectrum_to_dict(spectrum: Spectrum) -> Dict[str, Any]:
+    """
+    Convert an extracted MS2 spectrum to a JSON-ready dictionary.
     
-    for peak in xcms_peaks:
-        peak_mz = peak.get("mz", 0)
-        peak_rt = peak.get("rt", 0)
-        
-        mz_diff = abs(peak_mz - mz)
-        rt_diff = abs(peak_rt - rt)
+    Args:
+        spectrum: matchms Spectrum returned by extract_ms2_spectra
         
-        if mz_diff <= mz_tolerance and rt_diff <= rt_tolerance:
-            # Score based on combined distance (weighted)
-            score = (mz_diff / mz_tolerance) + (rt_diff / rt_tolerance)
-            if score < best_score:
-                best_score = score
-                best_match = peak
-    
-    return best_match
+    Returns:
+        Dictionary containing spectrum data
+    """
+    return {
+        "feature_name": spectrum.get("feature_name", ""),
+        "precursor_mz": spectrum.get("precursor_mz"),
+        "rt": spectrum.get("retention_time"),
+        "mz": spectrum.peaks.mz.tolist(),
+        "intensities": spectrum.peaks.intensities.tolist(),
+        "n_peaks": len(spectrum.peaks.mz),
+        "matched_xcms_peak": spectrum.get("matched_xcms_peak", "")
+    }
 
 
 def convert_to_matchms_spectrum(spectrum_dict: Dict[str, Any]) -> Spectrum:
@@ -140,8 +307,8 @@ def convert_to_matchms_spectrum(spectrum_dict: Dict[str, Any]) -> Spectrum:
     Returns:
         matchms Spectrum object
     """
-    mz = np.array(spectrum_dict["mz"])
-    intensities = np.array(spectrum_dict["intensities"])
+    mz = np.asarray(spectrum_dict["mz"], dtype=np.float32)
+    intensities = np.asarray(spectrum_dict["intensities"], dtype=np.float32)
     
     metadata = {
         "precursor_mz": spectrum_dict["precursor_mz"],
@@ -157,4 +324,3 @@ def convert_to_matchms_spectrum(spectrum_dict: Dict[str, Any]) -> Spectrum:
     )
     
     return spectrum
-
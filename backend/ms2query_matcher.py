@@ -1,8 +1,17 @@
 """MS2Query integration for ML-assisted spectral matching."""
+import functools
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Dict, Any, Optional
 from pathlib import Path
 from matchms import Spectrum
 import numpy as np
+from backend.library_parser import parse_library_file, library_file_key
+from backend.config import (
+    MATCHING_WORKERS,
+    MATCHING_PARALLEL_MIN_QUERIES,
+    MS2QUERY_MODELS_DIR,
+    MS2QUERY_MODEL_SUFFIXES
+)
 
 try:
     from ms2query.ms2library import MS2Library
@@ -18,17 +27,20 @@ def match_with_ms2query(
     library_path: Optional[Path] = None,
     ms2library: Optional[Any] = None,
     analog_search: bool = True,
-    top_n: int = 10
+    top_n: int = 10,
+    n_workers: int = MATCHING_WORKERS
 ) -> List[Dict[str, Any]]:
     """
     Match query spectra against library using MS2Query.
     
     Args:
         query_spectra: List of matchms Spectrum objects to match
-        library_path: Path to MS2Query library directory (optional if ms2library provided)
+        library_path: Path to MS2Query library directory, e.g. one created by
+            build_ms2query_index (optional if ms2library provided)
         ms2library: Pre-initialized MS2Library object (optional)
         analog_search: Whether to perform analog search (True) or exact match only (False)
         top_n: Number of top matches to return per query
+        n_workers: Number of threads matching queries concurrently
         
     Returns:
         List of matching results dictionaries
@@ -36,98 +48,257 @@ def match_with_ms2query(
     if not MS2QUERY_AVAILABLE:
         raise ImportError("MS2Query is not installed. Install with: pip install ms2query")
     
-    results = []
-    
     # Initialize library if not provided
     if ms2library is None:
         if library_path is None:
             raise ValueError("Either library_path or ms2library must be provided")
+        ms2library = load_ms2query_library(library_path)
+    
+    # MS2Query's analog search takes the whole query list at once, batching
+    # embedding computation and library lookups across spectra
+    if analog_search and hasattr(ms2library, "analog_search_return_results_tables"):
         try:
-            # Try to create library from directory
-            # MS2Query expects a directory with model files
-            from ms2query.ms2library import create_library_object_from_one_dir
-            try:
-                ms2library = create_library_object_from_one_dir(str(library_path.parent))
-            except:
-                # Fallback: try to load from sqlite file if it exists
-                sqlite_file = library_path.parent / "library.sqlite"
-                if sqlite_file.exists():
-                    ms2library = MS2Library(sqlite_file_name=str(sqlite_file))
-                else:
-                    raise ValueError("MS2Query library files not found. Please ensure library directory contains required model files.")
+            return _match_batch_with_ms2query(query_spectra, ms2library, top_n)
         except Exception as e:
-            raise ValueError(f"Error loading MS2Query library: {str(e)}")
+            print(f"Batched MS2Query search failed ({str(e)}), matching spectra one by one")
+    
+    if len(query_spectra) < MATCHING_PARALLEL_MIN_QUERIES:
+        n_workers = 1
+    
+    match_one = functools.partial(
+        _match_one_with_ms2query,
+        ms2library=ms2library,
+        analog_search=analog_search,
+        top_n=top_n
+    )
     
-    # Match each query spectrum
-    for i, query_spectrum in enumerate(query_spectra):
+    # Queries are independent; threads share the loaded library and models
+    with ThreadPoolExecutor(max_workers=max(1, n_workers)) as executor:
+        return list(executor.map(match_one, range(len(query_spectra)), query_spectra))
+
+
+def _match_one_with_ms2query(
+    i: int,
+    query_spectrum: Spectrum,
+    ms2library: Any,
+    analog_search: bool,
+    top_n: int
+) -> Dict[str, Any]:
+    """Match a single query spectrum with MS2Query."""
+    try:
+        # Run MS2Query matching
+        # Note: MS2Query API may vary by version - this is a common pattern
         try:
-            # Run MS2Query matching
-            # Note: MS2Query API may vary by version - this is a common pattern
-            try:
-                # Try the match_spectrum method
-                matches = ms2library.match_spectrum(
-                    query_spectrum,
-                    analog_search=analog_search,
-                    number_of_results=top_n
-                )
-            except AttributeError:
-                # Alternative API: use run_ms2query functions
-                from ms2query.run_ms2query import run_ms2query
-                matches = run_ms2query(
-                    query_spectrum,
-                    ms2library,
-                    analog_search=analog_search,
-                    number_of_results=top_n
-                )
-            
-            match_results = []
-            for match in matches:
-                match_dict = {
-                    "library_id": match.get("library_id", ""),
-                    "compound_name": match.get("compound_name", ""),
-                    "score": float(match.get("ms2query_score", 0.0)),
-                    "algorithm": "ms2query",
-                    "matched_peaks": match.get("matched_peaks", 0),
-                    "total_peaks": len(query_spectrum.peaks.mz),
-                    "metadata": {
-                        "precursor_mz": match.get("precursor_mz"),
-                        "retention_time": match.get("retention_time"),
-                        "smiles": match.get("smiles"),
-                        "inchi": match.get("inchi"),
-                        "inchikey": match.get("inchikey"),
-                        "analog": match.get("analog", False)
-                    }
-                }
-                match_results.append(match_dict)
-            
-            results.append({
-                "query_index": i,
-                "query_spectrum": {
-                    "precursor_mz": query_spectrum.get("precursor_mz"),
-                    "retention_time": query_spectrum.get("retention_time")
-                },
-                "matches": match_results,
-                "best_match": match_results[0] if match_results else None
-            })
-            
-        except Exception as e:
-            print(f"Error matching spectrum {i}: {str(e)}")
-            results.append({
-                "query_index": i,
-                "error": str(e),
-                "matches": []
-            })
+            # Try the match_spectrum method
+            matches = ms2library.match_spectrum(
+                query_spectrum,
+                analog_search=analog_search,
+                number_of_results=top_n
+            )
+        except AttributeError:
+            # Alternative API: use run_ms2query functions
+            from ms2query.run_ms2query import run_ms2query
+            matches = run_ms2query(
+                query_spectrum,
+                ms2library,
+                analog_search=analog_search,
+                number_of_results=top_n
+            )
+        
+        return _ms2query_result(i, query_spectrum, matches)
+    
+    except Exception as e:
+        print(f"Error matching spectrum {i}: {str(e)}")
+        return {
+            "query_index": i,
+            "error": str(e),
+            "matches": []
+        }
+
+
+def _match_batch_with_ms2query(
+    query_spectra: List[Spectrum],
+    ms2library: Any,
+    top_n: int
+) -> List[Dict[str, Any]]:
+    """
+    Match all query spectra with a single MS2Query analog search.
+    
+    Args:
+        query_spectra: List of matchms Spectrum objects to match
+        ms2library: Loaded MS2Library object
+        top_n: Number of top matches to return per query
+        
+    Returns:
+        List of matching results dictionaries, one per query in order
+    """
+    results_tables = ms2library.analog_search_return_results_tables(list(query_spectra))
+    
+    results = []
+    for i, (query_spectrum, results_table) in enumerate(zip(query_spectra, results_tables)):
+        matches = []
+        if results_table is not None:
+            top_analogs = results_table.export_to_dataframe(top_n)
+            if top_analogs is not None:
+                matches = [
+                    _results_table_row_to_match(row)
+                    for row in top_analogs.to_dict(orient="records")
+                ]
+        results.append(_ms2query_result(i, query_spectrum, matches))
     
     return results
 
 
+def _results_table_row_to_match(row: Dict[str, Any]) -> Dict[str, Any]:
+    """Map a row of an MS2Query results table to the match fields used below."""
+    # Missing values in the results table come through as NaN
+    row = {k: (None if isinstance(v, float) and v != v else v) for k, v in row.items()}
+    return {
+        "library_id": row.get("library_spectrum_id") or row.get("spectrum_id") or "",
+        "compound_name": row.get("analog_compound_name") or row.get("compound_name") or "",
+        "ms2query_score": row.get("ms2query_model_prediction") or 0.0,
+        "precursor_mz": row.get("precursor_mz_analog"),
+        "retention_time": row.get("retention_time"),
+        "smiles": row.get("smiles"),
+        "inchi": row.get("inchi"),
+        "inchikey": row.get("inchikey"),
+        "analog": True
+    }
+
+
+def _ms2query_result(
+    i: int,
+    query_spectrum: Spectrum,
+    matches: List[Dict[str, Any]]
+) -> Dict[str, Any]:
+    """Build the matching result dictionary for one query from MS2Query matches."""
+    match_results = []
+    for match in matches:
+        match_dict = {
+            "library_id": match.get("library_id", ""),
+            "compound_name": match.get("compound_name", ""),
+            "score": float(match.get("ms2query_score", 0.0)),
+            "algorithm": "ms2query",
+            "matched_peaks": match.get("matched_peaks", 0),
+            "total_peaks": len(query_spectrum.peaks.mz),
+            "metadata": {
+                "precursor_mz": match.get("precursor_mz"),
+                "retention_time": match.get("retention_time"),
+                "smiles": match.get("smiles"),
+                "inchi": match.get("inchi"),
+                "inchikey": match.get("inchikey"),
+                "analog": match.get("analog", False)
+            }
+        }
+        match_results.append(match_dict)
+    
+    return {
+        "query_index": i,
+        "query_spectrum": {
+            "precursor_mz": query_spectrum.get("precursor_mz"),
+            "retention_time": query_spectrum.get("retention_time")
+        },
+        "matches": match_results,
+        "best_match": match_results[0] if match_results else None
+    }
+
+
+@functools.lru_cache(maxsize=4)
+def load_ms2query_library(library_dir: Path) -> Any:
+    """
+    Load an MS2Query library from a directory of model and library files.
+    
+    Loaded libraries are cached per directory, so the models are read from
+    disk once per process.
+    
+    Args:
+        library_dir: MS2Query library directory
+        
+    Returns:
+        MS2Library object
+    """
+    if not MS2QUERY_AVAILABLE:
+        raise ImportError("MS2Query is not installed. Install with: pip install ms2query")
+    
+    try:
+        # MS2Query expects a directory with model files
+        from ms2query.ms2library import create_library_object_from_one_dir
+        try:
+            return create_library_object_from_one_dir(str(library_dir))
+        except:
+            # Fallback: try to load from sqlite file if it exists
+            sqlite_file = library_dir / "library.sqlite"
+            if sqlite_file.exists():
+                return MS2Library(sqlite_file_name=str(sqlite_file))
+            raise ValueError("MS2Query library files not found. Please ensure library directory contains required model files.")
+    except Exception as e:
+        raise ValueError(f"Error loading MS2Query library: {str(e)}")
+
+
+def build_ms2query_index(
+    library_path: Path,
+    cache_root: Path,
+    ion_mode: str = "positive"
+) -> Path:
+    """
+    Build the MS2Query library for a spectral library file once and cache it.
+    
+    The library is stored under ``cache_root/<library_file_key>/``, keyed by
+    the file's path, size and mtime so the file is not read to find it; if a
+    complete build already exists there it is reused without rebuilding.
+    
+    Args:
+        library_path: Path to the uploaded spectral library file
+        cache_root: Directory holding cached MS2Query libraries
+        ion_mode: Ionization mode ("positive" or "negative")
+        
+    Returns:
+        Path to the MS2Query library directory
+    """
+    index_dir = cache_root / library_file_key(library_path)
+    complete_marker = index_dir / ".complete"
+    if complete_marker.exists():
+        return index_dir
+    
+    index_dir.mkdir(parents=True, exist_ok=True)
+    create_ms2query_library(parse_library_file(library_path), index_dir, ion_mode=ion_mode)
+    complete_marker.touch()
+    return index_dir
+
+
+def get_pretrained_models_dir(ion_mode: str = "positive") -> Path:
+    """
+    Return the directory of pretrained MS2Query models, downloading them once.
+    
+    Args:
+        ion_mode: Ionization mode ("positive" or "negative")
+        
+    Returns:
+        Directory containing the pretrained model files
+    """
+    if not MS2QUERY_AVAILABLE:
+        raise ImportError("MS2Query is not installed")
+    
+    models_dir = MS2QUERY_MODELS_DIR / ion_mode
+    if not any(p.suffix in MS2QUERY_MODEL_SUFFIXES for p in models_dir.glob("*")):
+        from ms2query.run_ms2query import download_zenodo_files
+        models_dir.mkdir(parents=True, exist_ok=True)
+        download_zenodo_files(ion_mode, str(models_dir), only_models=True)
+    return models_dir
+
+
 def create_ms2query_library(
     library_spectra: List[Spectrum],
     output_path: Path,
     ion_mode: str = "positive"
 ) -> Path:
     """
-    Create an MS2Query library from matchms spectra.
+    Create an MS2Query library from matchms spectra using pretrained models.
+    
+    Only the library files (SQLite database and embeddings) are computed for
+    the spectra; the models themselves are not retrained. The pretrained
+    model files are linked into ``output_path`` so it can be loaded as one
+    directory.
     
     Args:
         library_spectra: List of matchms Spectrum objects
@@ -141,19 +312,27 @@ def create_ms2query_library(
         raise ImportError("MS2Query is not installed")
     
     try:
-        from ms2query.create_new_library.train_models import clean_and_train_models
+        from ms2query.create_new_library.library_files_creator import LibraryFilesCreator
+        
+        models_dir = get_pretrained_models_dir(ion_mode)
+        for model_file in models_dir.iterdir():
+            if model_file.suffix not in MS2QUERY_MODEL_SUFFIXES:
+                continue
+            link = output_path / model_file.name
+            if not link.exists():
+                link.symlink_to(model_file.resolve())
         
-        # Save spectra to temporary file first
-        temp_file = output_path / "library_spectra.mgf"
-        from matchms import exporting
-        exporting.save_as_mgf(list(library_spectra), str(temp_file))
+        s2v_model = next(output_path.glob("*.model"))
+        ms2ds_model = next(p for p in output_path.iterdir() if p.suffix in (".pt", ".hdf5"))
         
-        # Train models
-        clean_and_train_models(
-            spectrum_file=str(temp_file),
-            ion_mode=ion_mode,
-            output_folder=str(output_path)
-        )
+        # Compound classes are looked up online, so they are left out
+        LibraryFilesCreator(
+            list(library_spectra),
+            output_directory=str(output_path),
+            s2v_model_file_name=str(s2v_model),
+            ms2ds_model_file_name=str(ms2ds_model),
+            add_compound_classes=False
+        ).create_all_library_files()
         
         return output_path
     except Exception as e:
@@ -1,11 +1,24 @@
 """Process and combine XCMS data with MS2 matching results."""
+from pathlib import Path
 from typing import List, Dict, Any, Optional
-from backend.data_loader import load_xcms_data, get_peak_info
+import numpy as np
+import pandas as pd
+from backend.data_loader import (
+    load_xcms_data, as_peak_table, query_mz_window, PeaksLike
+)
 from backend.models import MatchingResult, SpectrumMatch
+from backend.utils import safe_json_save
+
+
+EXPORT_COLUMNS = [
+    "feature_name", "precursor_mz", "retention_time", "xcms_mz", "xcms_rt",
+    "compound_name", "match_score", "algorithm", "confidence_score",
+    "matched_peaks", "smiles", "inchi", "inchikey"
+]
 
 
 def process_matching_results(
-    xcms_peaks: List[Dict[str, Any]],
+    xcms_peaks: PeaksLike,
     matching_results: List[Dict[str, Any]],
     algorithm: str = "ms2query"
 ) -> List[Dict[str, Any]]:
@@ -13,16 +26,19 @@ def process_matching_results(
     Combine XCMS peak data with MS2 matching results.
     
     Args:
-        xcms_peaks: List of XCMS peak dictionaries
+        xcms_peaks: PeakTable or list of XCMS peak dictionaries
         matching_results: List of matching result dictionaries
         algorithm: Algorithm used for matching
         
     Returns:
         List of combined results with metabolite annotations
     """
+    # Build the name index and m/z/RT arrays once for all lookups below
+    peak_table = as_peak_table(xcms_peaks)
+    confidence_scores = calculate_confidence_scores(matching_results)
     processed_results = []
     
-    for match_result in matching_results:
+    for match_result, confidence_score in zip(matching_results, confidence_scores.tolist()):
         query_index = match_result.get("query_index", -1)
         query_spectrum = match_result.get("query_spectrum", {})
         matches = match_result.get("matches", [])
@@ -30,14 +46,14 @@ def process_matching_results(
         
         # Find corresponding XCMS peak
         feature_name = query_spectrum.get("feature_name", f"Feature_{query_index}")
-        xcms_peak = get_peak_info(xcms_peaks, feature_name)
+        xcms_peak = peak_table.by_name.get(feature_name)
         
         if xcms_peak is None:
             # Try to find by m/z and RT if feature name not found
             precursor_mz = query_spectrum.get("precursor_mz")
             rt = query_spectrum.get("retention_time")
             if precursor_mz and rt:
-                xcms_peak = find_peak_by_mz_rt(xcms_peaks, precursor_mz, rt)
+                xcms_peak = find_peak_by_mz_rt(peak_table, precursor_mz, rt)
         
         # Create combined result
         combined_result = {
@@ -49,7 +65,7 @@ def process_matching_results(
             "matches": matches,
             "best_match": best_match,
             "match_count": len(matches),
-            "confidence_score": calculate_confidence_score(matches, best_match)
+            "confidence_score": confidence_score
         }
         
         processed_results.append(combined_result)
@@ -58,20 +74,21 @@ def process_matching_results(
 
 
 def find_peak_by_mz_rt(
-    peaks: List[Dict[str, Any]],
+    peaks: PeaksLike,
     mz: float,
     rt: float,
     mz_tolerance: float = 0.01,
     rt_tolerance: float = 30.0
 ) -> Optional[Dict[str, Any]]:
-    """Find XCMS peak by m/z and RT."""
-    for peak in peaks:
-        peak_mz = peak.get("mz", 0)
-        peak_rt = peak.get("rt", 0)
-        
-        if abs(peak_mz - mz) <= mz_tolerance and abs(peak_rt - rt) <= rt_tolerance:
-            return peak
-    return None
+    """Find the first XCMS peak (in table order) within the m/z and RT tolerances."""
+    table = as_peak_table(peaks)
+    
+    # Binary-search the m/z window, then filter its peaks by RT
+    window = query_mz_window(table, mz - mz_tolerance, mz + mz_tolerance)
+    hits = window[np.abs(table.rt[window] - rt) <= rt_tolerance]
+    
+    # The window is ordered by m/z; the first hit in table order has the lowest index
+    return table.peaks[hits.min()] if hits.size else None
 
 
 def calculate_confidence_score(
@@ -81,6 +98,8 @@ def calculate_confidence_score(
     """
     Calculate confidence score based on matching results.
     
+    Single-result form of calculate_confidence_scores.
+    
     Args:
         matches: List of all matches
         best_match: Best match dictionary
@@ -88,31 +107,91 @@ def calculate_confidence_score(
     Returns:
         Confidence score between 0 and 1
     """
-    if not best_match:
-        return 0.0
+    return float(calculate_confidence_scores([{"matches": matches, "best_match": best_match}])[0])
+
+
+def calculate_confidence_scores(matching_results: List[Dict[str, Any]]) -> np.ndarray:
+    """
+    Calculate confidence scores for many matching results at once.
+    
+    Each score starts from the best match score, is boosted (or penalized)
+    by agreement with the top three matches and scaled down when the best
+    match shares few peaks with the query.
+    
+    Args:
+        matching_results: List of matching result dictionaries
+        
+    Returns:
+        Array of confidence scores between 0 and 1, one per result
+    """
+    inputs = _confidence_inputs(matching_results)
+    n_results = len(matching_results)
+    best_score = inputs["best_score"]
+    n_matches = inputs["n_matches"]
     
-    # Base score from best match
-    base_score = best_match.get("score", 0.0)
+    # Sum the top three match scores per result from one flat score array
+    n_top = np.minimum(n_matches, 3)
+    top_sum = np.bincount(
+        np.repeat(np.arange(n_results), n_top),
+        weights=inputs["top_scores"], minlength=n_results
+    )
     
-    # Boost if multiple high-quality matches agree
-    if len(matches) > 1:
-        top_scores = [m.get("score", 0.0) for m in matches[:3]]
-        avg_top_score = sum(top_scores) / len(top_scores)
-        consistency_boost = min(0.2, (avg_top_score - base_score) * 0.5)
-        base_score += consistency_boost
+    # Boost (or penalize) by agreement with the top three matches
+    avg_top_score = np.divide(
+        top_sum, n_top,
+        out=np.zeros(n_results), where=n_top > 0
+    )
+    boost = np.where(
+        n_matches > 1,
+        np.minimum(0.2, (avg_top_score - best_score) * 0.5),
+        0.0
+    )
     
     # Penalize if matched peaks are too few
-    matched_peaks = best_match.get("matched_peaks", 0)
-    total_peaks = best_match.get("total_peaks", 1)
-    peak_ratio = matched_peaks / total_peaks if total_peaks > 0 else 0
-    base_score *= (0.5 + 0.5 * peak_ratio)
+    total_peaks = inputs["total_peaks"]
+    peak_ratio = np.divide(
+        inputs["matched_peaks"], total_peaks,
+        out=np.zeros(n_results), where=total_peaks > 0
+    )
+    confidence = (best_score + boost) * (0.5 + 0.5 * peak_ratio)
     
-    return min(1.0, max(0.0, base_score))
+    return np.where(inputs["has_best"], np.clip(confidence, 0.0, 1.0), 0.0)
+
+
+def _confidence_inputs(matching_results: List[Dict[str, Any]]) -> Dict[str, np.ndarray]:
+    """Collect the per-result columns confidence scoring needs in one pass."""
+    has_best = []
+    best_score = []
+    matched_peaks = []
+    total_peaks = []
+    n_matches = []
+    top_scores = []
+    
+    for result in matching_results:
+        best_match = result.get("best_match")
+        matches = result.get("matches", [])
+        has_best.append(bool(best_match))
+        best_match = best_match or {}
+        best_score.append(best_match.get("score", 0.0))
+        matched_peaks.append(best_match.get("matched_peaks", 0))
+        total_peaks.append(best_match.get("total_peaks", 1))
+        n_matches.append(len(matches))
+        top_scores.extend(m.get("score", 0.0) for m in matches[:3])
+    
+    return {
+        "has_best": np.array(has_best, dtype=bool),
+        "best_score": np.array(best_score, dtype=np.float64),
+        "matched_peaks": np.array(matched_peaks, dtype=np.float64),
+        "total_peaks": np.array(total_peaks, dtype=np.float64),
+        "n_matches": np.array(n_matches, dtype=np.int64),
+        "top_scores": np.array(top_scores, dtype=np.float64)
+    }
 
 
 def format_results_for_export(
     processed_results: List[Dict[str, Any]],
-    format: str = "json"
+    format: str = "json",
+    output_path: Optional[Path] = None
 ) -> Any:
     """
     Format processed results for export.
@@ -120,41 +199,98 @@ def format_results_for_export(
     Args:
         processed_results: List of processed result dictionaries
         format: Export format ("json" or "csv")
+        output_path: Optional file to write the export to
         
     Returns:
-        Formatted data ready for export
+        Formatted data ready for export, or output_path once written
     """
     if format == "json":
-        return processed_results
+        if output_path is None:
+            return processed_results
+        if not safe_json_save(processed_results, output_path):
+            raise ValueError(f"Could not write JSON export to {output_path}")
+        return output_path
     elif format == "csv":
-        # Flatten for CSV export
-        csv_rows = []
-        for result in processed_results:
-            xcms_peak = result.get("xcms_peak", {})
-            best_match = result.get("best_match", {})
-            metadata = best_match.get("metadata", {})
-            
-            row = {
-                "feature_name": result.get("feature_name", ""),
-                "precursor_mz": result.get("precursor_mz", ""),
-                "retention_time": result.get("retention_time", ""),
-                "xcms_mz": xcms_peak.get("mz", ""),
-                "xcms_rt": xcms_peak.get("rt", ""),
-                "compound_name": best_match.get("compound_name", ""),
-                "match_score": best_match.get("score", ""),
-                "algorithm": result.get("algorithm", ""),
-                "confidence_score": result.get("confidence_score", ""),
-                "matched_peaks": best_match.get("matched_peaks", ""),
-                "smiles": metadata.get("smiles", ""),
-                "inchi": metadata.get("inchi", ""),
-                "inchikey": metadata.get("inchikey", "")
-            }
-            csv_rows.append(row)
-        return csv_rows
+        if output_path is None:
+            return [_export_row(result) for result in processed_results]
+        results_to_export_frame(processed_results).to_csv(output_path, index=False)
+        return output_path
     else:
         raise ValueError(f"Unsupported format: {format}")
 
 
+def results_to_export_frame(processed_results: List[Dict[str, Any]]) -> pd.DataFrame:
+    """
+    Flatten processed results into the CSV export columns.
+    
+    Args:
+        processed_results: List of processed result dictionaries
+        
+    Returns:
+        DataFrame with one row per result and EXPORT_COLUMNS as columns
+    """
+    return pd.DataFrame(
+        [_export_row(result) for result in processed_results],
+        columns=EXPORT_COLUMNS
+    )
+
+
+def _export_row(result: Dict[str, Any]) -> Dict[str, Any]:
+    """Flatten one processed result into a CSV export row."""
+    xcms_peak = result.get("xcms_peak") or {}
+    best_match = result.get("best_match") or {}
+    metadata = best_match.get("metadata") or {}
+    
+    return {
+        "feature_name": result.get("feature_name", ""),
+        "precursor_mz": result.get("precursor_mz", ""),
+        "retention_time": result.get("retention_time", ""),
+        "xcms_mz": xcms_peak.get("mz", ""),
+        "xcms_rt": xcms_peak.get("rt", ""),
+        "compound_name": best_match.get("compound_name", ""),
+        "match_score": best_match.get("score", ""),
+        "algorithm": result.get("algorithm", ""),
+        "confidence_score": result.get("confidence_score", ""),
+        "matched_peaks": best_match.get("matched_peaks", ""),
+        "smiles": metadata.get("smiles", ""),
+        "inchi": metadata.get("inchi", ""),
+        "inchikey": metadata.get("inchikey", "")
+    }
+
+
+def _float_column(values: List[Any]) -> pd.Series:
+    """Build a float64 column, turning None into NaN."""
+    return pd.Series(values, dtype="float64")
+
+
+def results_to_frame(processed_results: List[Dict[str, Any]]) -> pd.DataFrame:
+    """
+    Collect the per-feature scalar fields of processed results into columns.
+    
+    One row per result, in order. Missing numbers become NaN; the nested
+    match lists and XCMS peak dictionaries are left out.
+    
+    Args:
+        processed_results: List of processed result dictionaries
+        
+    Returns:
+        DataFrame with feature, best-match and confidence columns
+    """
+    best_matches = [r.get("best_match") or {} for r in processed_results]
+    
+    return pd.DataFrame({
+        "feature_name": pd.Series([r.get("feature_name") for r in processed_results], dtype=object),
+        "precursor_mz": _float_column([r.get("precursor_mz") for r in processed_results]),
+        "retention_time": _float_column([r.get("retention_time") for r in processed_results]),
+        "algorithm": pd.Series([r.get("algorithm", "unknown") for r in processed_results], dtype=object),
+        "has_match": pd.Series([bool(r.get("best_match")) for r in processed_results], dtype=bool),
+        "best_score": _float_column([m.get("score") for m in best_matches]),
+        "matched_peaks": _float_column([m.get("matched_peaks") for m in best_matches]),
+        "total_peaks": _float_column([m.get("total_peaks") for m in best_matches]),
+        "confidence_score": _float_column([r.get("confidence_score") for r in processed_results])
+    })
+
+
 def generate_summary_statistics(
     processed_results: List[Dict[str, Any]]
 ) -> Dict[str, Any]:
@@ -167,17 +303,22 @@ def generate_summary_statistics(
     Returns:
         Dictionary with summary statistics
     """
-    total_features = len(processed_results)
-    matched_features = sum(1 for r in processed_results if r.get("best_match"))
-    high_confidence = sum(1 for r in processed_results if r.get("confidence_score", 0) >= 0.7)
+    df = results_to_frame(processed_results)
+    confidence = df["confidence_score"]
     
-    scores = [r.get("confidence_score", 0) for r in processed_results if r.get("confidence_score")]
-    avg_score = sum(scores) / len(scores) if scores else 0.0
+    total_features = len(df)
+    matched_features = int(df["has_match"].sum())
+    high_confidence = int((confidence >= 0.7).sum())
     
-    algorithms = {}
-    for result in processed_results:
-        algo = result.get("algorithm", "unknown")
-        algorithms[algo] = algorithms.get(algo, 0) + 1
+    # Missing and zero confidence scores are left out of the average
+    scored = confidence[confidence.notna() & (confidence != 0)]
+    avg_score = float(scored.mean()) if len(scored) else 0.0
+    
+    # Counted in order of first appearance
+    algorithms = {
+        algo: int(count)
+        for algo, count in df["algorithm"].value_counts(sort=False, dropna=False).items()
+    }
     
     return {
         "total_features": total_features,
@@ -187,4 +328,3 @@ def generate_summary_statistics(
         "average_confidence_score": avg_score,
         "algorithms_used": algorithms
     }
-
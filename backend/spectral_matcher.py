@@ -1,5 +1,8 @@
 """Traditional spectral matching algorithms."""
-from typing import List, Dict, Any, Optional
+import functools
+import hashlib
+from dataclasses import dataclass
+from typing import List, Dict, Any, Optional, Tuple
 from matchms import Spectrum
 from matchms.similarity import (
     CosineGreedy,
@@ -7,6 +10,20 @@ from matchms.similarity import (
     DotProduct
 )
 import numpy as np
+from scipy import sparse
+from backend.config import (
+    BINNED_BIN_WIDTH,
+    BINNED_MZ_MAX,
+    SPARSE_BIN_WIDTH,
+    GPU_QUERY_BATCH,
+    BINNED_BLOCK_ROWS
+)
+
+try:
+    from numba import njit, prange
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
 
 
 def match_with_traditional(
@@ -15,79 +32,171 @@ def match_with_traditional(
     algorithm: str = "cosine",
     mz_tolerance: float = 0.01,
     min_score: float = 0.0,
-    top_n: int = 10
+    top_n: int = 10,
+    precursor_tolerance_ppm: Optional[float] = None
 ) -> List[Dict[str, Any]]:
     """
     Match query spectra against library using traditional algorithms.
     
+    Matching runs in the calling process; the API already runs each request
+    in one of its worker processes. Only the Numba cosine kernel spreads
+    queries over threads; the other algorithms score the whole batch in
+    one matrix product or matchms call.
+    
     Args:
         query_spectra: List of matchms Spectrum objects to match
         library_spectra: List of library matchms Spectrum objects
-        algorithm: Matching algorithm ("dot_product", "cosine", "modified_cosine")
+        algorithm: Matching algorithm ("dot_product", "cosine", "modified_cosine",
+            "binned_cosine", "sparse_cosine", "gpu_cosine")
         mz_tolerance: m/z tolerance for matching (Da)
         min_score: Minimum score threshold
         top_n: Number of top matches to return per query
+        precursor_tolerance_ppm: If set, only score library spectra whose
+            precursor m/z lies within this ppm window of the query's
+            precursor m/z. Queries without a precursor m/z are scored
+            against the whole library.
         
     Returns:
         List of matching results dictionaries
     """
-    # Initialize similarity function
+    # Library peaks are flattened once and shared by every query
+    library = prepare_spectra(library_spectra)
+    
+    return _match_query_batch(
+        query_spectra,
+        library_spectra,
+        library,
+        algorithm,
+        mz_tolerance,
+        min_score,
+        top_n,
+        precursor_tolerance_ppm
+    )
+
+
+@functools.lru_cache(maxsize=8)
+def _get_similarity_function(algorithm: str, mz_tolerance: float):
+    """Create (once per algorithm and tolerance) the matchms similarity function."""
     if algorithm == "dot_product":
-        similarity_fn = DotProduct(tolerance=mz_tolerance)
+        return DotProduct(tolerance=mz_tolerance)
     elif algorithm == "cosine":
-        similarity_fn = CosineGreedy(tolerance=mz_tolerance)
+        return CosineGreedy(tolerance=mz_tolerance)
     elif algorithm == "modified_cosine":
-        similarity_fn = ModifiedCosine(tolerance=mz_tolerance)
+        return ModifiedCosine(tolerance=mz_tolerance)
     else:
         raise ValueError(f"Unknown algorithm: {algorithm}")
+
+
+def _match_query_batch(
+    query_spectra: List[Spectrum],
+    library_spectra: List[Spectrum],
+    library: "PreparedSpectra",
+    algorithm: str,
+    mz_tolerance: float,
+    min_score: float,
+    top_n: int,
+    precursor_tolerance_ppm: Optional[float]
+) -> List[Dict[str, Any]]:
+    """
+    Match a batch of query spectra against the library.
+    
+    Args:
+        query_spectra: Query spectra to match
+        library_spectra: List of library matchms Spectrum objects
+        library: Prepared peaks of library_spectra
+        algorithm: Matching algorithm
+        mz_tolerance: m/z tolerance for matching (Da)
+        min_score: Minimum score threshold
+        top_n: Number of top matches to return per query
+        precursor_tolerance_ppm: Optional precursor m/z prefilter (ppm)
+        
+    Returns:
+        List of matching results dictionaries
+    """
+    queries = prepare_spectra(query_spectra)
+    
+    # Library indices each query may match; None means the whole library
+    candidate_sets = None
+    
+    if algorithm == "cosine" and NUMBA_AVAILABLE:
+        if precursor_tolerance_ppm is not None:
+            candidate_sets = _precursor_candidates(
+                query_spectra,
+                library_spectra,
+                precursor_tolerance_ppm
+            )
+        score_matrix = greedy_cosine_scores(
+            library_spectra,
+            query_spectra,
+            mz_tolerance,
+            candidate_sets,
+            library,
+            queries
+        )
+    elif algorithm == "gpu_cosine":
+        if precursor_tolerance_ppm is not None:
+            candidate_sets = _precursor_candidates(
+                query_spectra,
+                library_spectra,
+                precursor_tolerance_ppm
+            )
+        score_matrix = gpu_cosine_scores(
+            library_spectra, query_spectra, top_n, candidate_sets, library
+        )
+    elif algorithm in ("binned_cosine", "sparse_cosine"):
+        if algorithm == "binned_cosine":
+            score_matrix = binned_cosine_scores(library_spectra, query_spectra)
+        else:
+            score_matrix = sparse_cosine_scores(library_spectra, query_spectra).tocsc()
+        if precursor_tolerance_ppm is not None:
+            candidate_sets = _precursor_candidates(
+                query_spectra,
+                library_spectra,
+                precursor_tolerance_ppm
+            )
+    elif precursor_tolerance_ppm is None:
+        # Score all query/library pairs in one batched call instead of per-pair dispatch
+        similarity_fn = _get_similarity_function(algorithm, mz_tolerance)
+        score_matrix = _score_matrix(similarity_fn, library_spectra, query_spectra)
+    else:
+        score_matrix = _score_precursor_candidates(
+            _get_similarity_function(algorithm, mz_tolerance),
+            query_spectra,
+            library_spectra,
+            precursor_tolerance_ppm
+        )
     
     results = []
     
     for i, query_spectrum in enumerate(query_spectra):
-        matches = []
-        
-        for lib_spectrum in library_spectra:
-            try:
-                # Calculate similarity score
-                score = similarity_fn.pair(query_spectrum, lib_spectrum)
-                
-                if score is None or score[0] < min_score:
-                    continue
-                
-                similarity_score = float(score[0])
-                
-                # Count matched peaks
-                matched_peaks = count_matched_peaks(
-                    query_spectrum,
-                    lib_spectrum,
-                    mz_tolerance
-                )
-                
-                match_dict = {
-                    "library_id": lib_spectrum.get("spectrum_id", f"lib_{i}"),
-                    "compound_name": lib_spectrum.get("compound_name") or \
-                                   lib_spectrum.get("name", "Unknown"),
-                    "score": similarity_score,
-                    "algorithm": algorithm,
-                    "matched_peaks": matched_peaks,
-                    "total_peaks": len(query_spectrum.peaks.mz),
-                    "metadata": {
-                        "precursor_mz": lib_spectrum.get("precursor_mz"),
-                        "retention_time": lib_spectrum.get("retention_time"),
-                        "smiles": lib_spectrum.get("smiles"),
-                        "inchi": lib_spectrum.get("inchi"),
-                        "inchikey": lib_spectrum.get("inchikey")
-                    }
-                }
-                matches.append(match_dict)
-                
-            except Exception as e:
-                print(f"Error matching spectrum {i} against library: {str(e)}")
-                continue
+        # Densify one query's column at a time for sparse score matrices
+        if sparse.issparse(score_matrix):
+            query_scores = score_matrix[:, [i]].toarray().ravel()
+        else:
+            query_scores = score_matrix[:, i]
+        
+        # Sort by score and take top N; matched peaks are only counted for these
+        if candidate_sets is None:
+            candidates = np.flatnonzero(query_scores >= min_score)
+        else:
+            candidates = candidate_sets[i][query_scores[candidate_sets[i]] >= min_score]
         
-        # Sort by score and take top N
-        matches.sort(key=lambda x: x["score"], reverse=True)
-        top_matches = matches[:top_n]
+        query_mz = queries.mz[queries.offsets[i]:queries.offsets[i + 1]]
+        top_matches = [
+            _build_match(
+                library_spectra[j],
+                j,
+                float(query_scores[j]),
+                algorithm,
+                _count_matched_mz(
+                    query_mz,
+                    library.mz[library.offsets[j]:library.offsets[j + 1]],
+                    mz_tolerance
+                ),
+                len(query_mz)
+            )
+            for j in _top_n_indices(query_scores, candidates, top_n)
+        ]
         
         results.append({
             "query_index": i,
@@ -102,6 +211,676 @@ def match_with_traditional(
     return results
 
 
+def _top_n_indices(scores: np.ndarray, candidates: np.ndarray, top_n: int) -> np.ndarray:
+    """
+    Return the top_n candidates by descending score.
+    
+    Ties keep ascending index order. np.argpartition narrows large candidate
+    sets to those scoring at least the top_n-th best score before sorting.
+    """
+    candidate_scores = scores[candidates]
+    if len(candidates) > top_n:
+        kth_best = -np.partition(-candidate_scores, top_n - 1)[top_n - 1]
+        keep = candidate_scores >= kth_best
+        candidates = candidates[keep]
+        candidate_scores = candidate_scores[keep]
+    
+    order = np.argsort(-candidate_scores, kind="stable")
+    return candidates[order[:top_n]]
+
+
+def _score_matrix(
+    similarity_fn,
+    library_spectra: List[Spectrum],
+    query_spectra: List[Spectrum]
+) -> np.ndarray:
+    """
+    Score every library spectrum against every query, shape (library, query).
+    
+    Pairs matchms cannot score (e.g. modified cosine without a precursor m/z)
+    are left at -inf so they are skipped rather than failing the whole batch.
+    """
+    if not query_spectra or not library_spectra:
+        return np.zeros((len(library_spectra), len(query_spectra)))
+    
+    if isinstance(similarity_fn, ModifiedCosine):
+        # Modified cosine needs both precursor m/z values; score the rest as one batch
+        lib_rows = [j for j, s in enumerate(library_spectra) if s.get("precursor_mz") is not None]
+        query_cols = [i for i, s in enumerate(query_spectra) if s.get("precursor_mz") is not None]
+        if len(lib_rows) < len(library_spectra) or len(query_cols) < len(query_spectra):
+            scores = np.full((len(library_spectra), len(query_spectra)), -np.inf)
+            if lib_rows and query_cols:
+                scores[np.ix_(lib_rows, query_cols)] = _score_matrix(
+                    similarity_fn,
+                    [library_spectra[j] for j in lib_rows],
+                    [query_spectra[i] for i in query_cols]
+                )
+            return scores
+    
+    try:
+        return _matchms_scores(similarity_fn, library_spectra, query_spectra)
+    except Exception as e:
+        print(f"Batched scoring failed, scoring library spectra one at a time: {str(e)}")
+    
+    scores = np.full((len(library_spectra), len(query_spectra)), -np.inf)
+    for j, lib_spectrum in enumerate(library_spectra):
+        try:
+            scores[j] = _matchms_scores(similarity_fn, [lib_spectrum], query_spectra)[0]
+        except Exception:
+            for i, query_spectrum in enumerate(query_spectra):
+                try:
+                    scores[j, i] = _matchms_scores(
+                        similarity_fn, [lib_spectrum], [query_spectrum]
+                    )[0, 0]
+                except Exception as e:
+                    print(f"Error matching spectrum {i} against library spectrum {j}: {str(e)}")
+    return scores
+
+
+def _matchms_scores(
+    similarity_fn,
+    library_spectra: List[Spectrum],
+    query_spectra: List[Spectrum]
+) -> np.ndarray:
+    """Run matchms' batched matrix scoring and return plain scores."""
+    scores = similarity_fn.matrix(library_spectra, query_spectra)
+    return scores["score"] if scores.dtype.names else scores
+
+
+def _score_precursor_candidates(
+    similarity_fn,
+    query_spectra: List[Spectrum],
+    library_spectra: List[Spectrum],
+    precursor_tolerance_ppm: float
+) -> np.ndarray:
+    """
+    Score each query only against library spectra within its precursor m/z window.
+    
+    Pairs outside the window are left at -inf so they never pass the score
+    threshold.
+    
+    Args:
+        similarity_fn: matchms similarity function
+        query_spectra: List of query matchms Spectrum objects
+        library_spectra: List of library matchms Spectrum objects
+        precursor_tolerance_ppm: Precursor m/z tolerance (ppm)
+        
+    Returns:
+        Score matrix of shape (library, query)
+    """
+    score_matrix = np.full((len(library_spectra), len(query_spectra)), -np.inf)
+    
+    candidate_sets = _precursor_candidates(query_spectra, library_spectra, precursor_tolerance_ppm)
+    for i, (query_spectrum, candidates) in enumerate(zip(query_spectra, candidate_sets)):
+        if len(candidates) == 0:
+            continue
+        
+        scores = _score_matrix(
+            similarity_fn,
+            [library_spectra[j] for j in candidates],
+            [query_spectrum]
+        )
+        score_matrix[candidates, i] = scores[:, 0]
+    
+    return score_matrix
+
+
+def _precursor_candidates(
+    query_spectra: List[Spectrum],
+    library_spectra: List[Spectrum],
+    precursor_tolerance_ppm: float
+) -> List[np.ndarray]:
+    """
+    Find the library spectra within each query's precursor m/z window.
+    
+    Library precursor m/z values are sorted once so each query's candidates
+    are found by binary search. Queries without a precursor m/z get the whole
+    library as candidates.
+    
+    Args:
+        query_spectra: List of query matchms Spectrum objects
+        library_spectra: List of library matchms Spectrum objects
+        precursor_tolerance_ppm: Precursor m/z tolerance (ppm)
+        
+    Returns:
+        Ascending library indices of the candidates for each query
+    """
+    # Library spectra without a precursor m/z sort to the end as NaN and are
+    # never inside a window
+    lib_pmz = np.array(
+        [s.get("precursor_mz") or np.nan for s in library_spectra],
+        dtype=np.float64
+    )
+    order = np.argsort(lib_pmz, kind="stable")
+    sorted_pmz = lib_pmz[order]
+    
+    candidate_sets = []
+    for query_spectrum in query_spectra:
+        query_pmz = query_spectrum.get("precursor_mz")
+        if query_pmz:
+            tolerance = query_pmz * precursor_tolerance_ppm * 1e-6
+            lo = np.searchsorted(sorted_pmz, query_pmz - tolerance, side="left")
+            hi = np.searchsorted(sorted_pmz, query_pmz + tolerance, side="right")
+            candidate_sets.append(np.sort(order[lo:hi]))
+        else:
+            candidate_sets.append(np.arange(len(library_spectra)))
+    
+    return candidate_sets
+
+
+def spectrum_peaks(spectrum: Spectrum) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Return a spectrum's ``(mz, intensities)`` arrays from a single access.
+    
+    matchms' ``Spectrum.peaks`` copies both peak arrays on every access, so
+    both are taken from one copy. Within a match call, spectra are prepared
+    once (see prepare_spectra) and their arrays reused from there.
+    
+    Args:
+        spectrum: matchms Spectrum object
+        
+    Returns:
+        Tuple of m/z (sorted) and intensity arrays
+    """
+    peaks = spectrum.peaks
+    return peaks.mz, peaks.intensities
+
+
+@dataclass
+class PreparedSpectra:
+    """
+    Peaks of many spectra concatenated into flat arrays.
+    
+    Peaks of spectrum ``k`` are ``mz[offsets[k]:offsets[k + 1]]`` (sorted by
+    m/z) with matching ``intensities``; ``norms`` holds each spectrum's
+    intensity L2 norm so cosine scores need no per-pair normalization.
+    """
+    mz: np.ndarray
+    intensities: np.ndarray
+    offsets: np.ndarray
+    norms: np.ndarray
+
+
+def prepare_spectra(spectra: List[Spectrum]) -> PreparedSpectra:
+    """
+    Concatenate spectra peaks and precompute their intensity norms once.
+    
+    Args:
+        spectra: List of matchms Spectrum objects
+        
+    Returns:
+        PreparedSpectra with float64 peak arrays
+    """
+    peaks = [spectrum_peaks(s) for s in spectra]
+    counts = np.array([len(mz) for mz, _ in peaks], dtype=np.int64)
+    offsets = np.zeros(len(spectra) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    
+    if len(spectra) and offsets[-1]:
+        mz = np.concatenate([np.asarray(mz, dtype=np.float64) for mz, _ in peaks])
+        intensities = np.concatenate([
+            np.asarray(intensities, dtype=np.float64) for _, intensities in peaks
+        ])
+    else:
+        mz = np.zeros(0)
+        intensities = np.zeros(0)
+    
+    # Same normalization as matchms' CosineGreedy (intensity power 1, m/z power 0)
+    # Reduce over non-empty spectra only: reduceat rejects a start index equal to
+    # the array length, which a trailing empty spectrum would produce
+    nonempty = counts > 0
+    norms = np.zeros(len(spectra))
+    if nonempty.any():
+        norms[nonempty] = np.sqrt(np.add.reduceat(intensities ** 2, offsets[:-1][nonempty]))
+    
+    return PreparedSpectra(mz, intensities, offsets, norms)
+
+
+def greedy_cosine_scores(
+    library_spectra: List[Spectrum],
+    query_spectra: List[Spectrum],
+    mz_tolerance: float,
+    candidate_sets: Optional[List[np.ndarray]] = None,
+    library: Optional[PreparedSpectra] = None,
+    queries: Optional[PreparedSpectra] = None
+) -> np.ndarray:
+    """
+    Greedy cosine scores for many spectrum pairs in one compiled kernel.
+    
+    Scores match matchms' CosineGreedy with default powers, but library and
+    query peaks are prepared once for the whole batch instead of once per
+    pair, and queries are scored on parallel threads.
+    
+    Args:
+        library_spectra: List of library matchms Spectrum objects
+        query_spectra: List of query matchms Spectrum objects
+        mz_tolerance: m/z tolerance for matching peaks (Da)
+        candidate_sets: Optional ascending library indices to score for each
+            query; other pairs are left at 0
+        library: Prepared peaks of library_spectra, if already available
+        queries: Prepared peaks of query_spectra, if already available
+        
+    Returns:
+        Score matrix of shape (library, query)
+    """
+    if library is None:
+        library = prepare_spectra(library_spectra)
+    if queries is None:
+        queries = prepare_spectra(query_spectra)
+    
+    if candidate_sets is None:
+        candidates = np.arange(len(library_spectra), dtype=np.int64)
+        candidate_starts = np.zeros(len(query_spectra), dtype=np.int64)
+        candidate_ends = np.full(len(query_spectra), len(library_spectra), dtype=np.int64)
+    else:
+        sizes = np.array([len(c) for c in candidate_sets], dtype=np.int64)
+        candidates = (
+            np.concatenate(candidate_sets).astype(np.int64) if len(candidate_sets)
+            else np.zeros(0, dtype=np.int64)
+        )
+        candidate_ends = np.cumsum(sizes)
+        candidate_starts = candidate_ends - sizes
+    
+    scores = np.zeros((len(library_spectra), len(query_spectra)))
+    _greedy_cosine_kernel(
+        library.mz, library.intensities, library.offsets, library.norms,
+        queries.mz, queries.intensities, queries.offsets, queries.norms,
+        candidates, candidate_starts, candidate_ends,
+        float(mz_tolerance), scores
+    )
+    return scores
+
+
+def _greedy_cosine_pair(mz1, int1, mz2, int2, tolerance):
+    """Sum of greedily paired intensity products, as in matchms' CosineGreedy."""
+    # Count the peak pairs within tolerance (same window rule as matchms)
+    n_pairs = 0
+    lowest = 0
+    for i in range(len(mz1)):
+        low_bound = mz1[i] - tolerance
+        high_bound = mz1[i] + tolerance
+        for j in range(lowest, len(mz2)):
+            if mz2[j] > high_bound:
+                break
+            if mz2[j] < low_bound:
+                lowest = j + 1
+            else:
+                n_pairs += 1
+    
+    if n_pairs == 0:
+        return 0.0
+    
+    pair1 = np.empty(n_pairs, dtype=np.int64)
+    pair2 = np.empty(n_pairs, dtype=np.int64)
+    products = np.empty(n_pairs)
+    k = 0
+    lowest = 0
+    for i in range(len(mz1)):
+        low_bound = mz1[i] - tolerance
+        high_bound = mz1[i] + tolerance
+        for j in range(lowest, len(mz2)):
+            if mz2[j] > high_bound:
+                break
+            if mz2[j] < low_bound:
+                lowest = j + 1
+            else:
+                pair1[k] = i
+                pair2[k] = j
+                products[k] = int1[i] * int2[j]
+                k += 1
+    
+    # Take pairs from the largest product down, each peak used at most once
+    order = np.argsort(products, kind="mergesort")[::-1]
+    used1 = np.zeros(len(mz1), dtype=np.bool_)
+    used2 = np.zeros(len(mz2), dtype=np.bool_)
+    score = 0.0
+    for k in order:
+        if not used1[pair1[k]] and not used2[pair2[k]]:
+            score += products[k]
+            used1[pair1[k]] = True
+            used2[pair2[k]] = True
+    return score
+
+
+def _greedy_cosine_kernel(
+    lib_mz, lib_int, lib_offsets, lib_norms,
+    query_mz, query_int, query_offsets, query_norms,
+    candidates, candidate_starts, candidate_ends,
+    tolerance, scores
+):
+    """Fill ``scores[library, query]`` for each query's candidate library spectra."""
+    for q in prange(len(query_offsets) - 1):
+        q_start = query_offsets[q]
+        q_end = query_offsets[q + 1]
+        for c in range(candidate_starts[q], candidate_ends[q]):
+            lib = candidates[c]
+            norm = lib_norms[lib] * query_norms[q]
+            if norm == 0:
+                continue
+            l_start = lib_offsets[lib]
+            l_end = lib_offsets[lib + 1]
+            scores[lib, q] = _greedy_cosine_pair(
+                lib_mz[l_start:l_end], lib_int[l_start:l_end],
+                query_mz[q_start:q_end], query_int[q_start:q_end],
+                tolerance
+            ) / norm
+
+
+if NUMBA_AVAILABLE:
+    _greedy_cosine_pair = njit(cache=True)(_greedy_cosine_pair)
+    _greedy_cosine_kernel = njit(parallel=True, cache=True)(_greedy_cosine_kernel)
+
+
+def spectrum_to_binned_vector(
+    spectrum: Spectrum,
+    mz_min: float = 0.0,
+    mz_max: float = BINNED_MZ_MAX,
+    bin_width: float = BINNED_BIN_WIDTH,
+    sqrt_intensity: bool = True
+) -> np.ndarray:
+    """
+    Bin a spectrum's intensities onto a fixed m/z grid.
+    
+    Peak intensities falling in the same bin are summed; peaks outside
+    [mz_min, mz_max) are dropped.
+    
+    Args:
+        spectrum: matchms Spectrum object
+        mz_min: Lower edge of the first bin
+        mz_max: Upper edge of the last bin
+        bin_width: Bin width (Da); 1.0 gives nominal-mass bins
+        sqrt_intensity: Whether to square-root the binned intensities
+        
+    Returns:
+        float32 vector with one entry per bin
+    """
+    n_bins = int(np.ceil((mz_max - mz_min) / bin_width))
+    mz, intensities = spectrum_peaks(spectrum)
+    mz = np.asarray(mz)
+    intensities = np.asarray(intensities, dtype=np.float32)
+    
+    keep = (mz >= mz_min) & (mz < mz_max)
+    bins = ((mz[keep] - mz_min) / bin_width).astype(np.int64)
+    
+    vector = np.zeros(n_bins, dtype=np.float32)
+    np.add.at(vector, bins, intensities[keep])
+    return np.sqrt(vector) if sqrt_intensity else vector
+
+
+def binned_spectra_matrix(
+    spectra: List[Spectrum],
+    mz_min: float = 0.0,
+    mz_max: float = BINNED_MZ_MAX,
+    bin_width: float = BINNED_BIN_WIDTH,
+    sqrt_intensity: bool = True,
+    dtype: Any = np.float32
+) -> np.ndarray:
+    """
+    Stack binned spectra into a row-normalized (n_spectra, n_bins) matrix.
+    
+    Rows are normalized in float32 before being stored, so a float16 matrix
+    only loses precision in the stored values, not in the normalization.
+    
+    Args:
+        spectra: List of matchms Spectrum objects
+        mz_min, mz_max, bin_width, sqrt_intensity: Binning parameters, see
+            spectrum_to_binned_vector
+        dtype: Storage dtype of the matrix (float32 or float16)
+        
+    Returns:
+        Matrix whose rows have unit L2 norm (all-zero rows stay zero)
+    """
+    n_bins = int(np.ceil((mz_max - mz_min) / bin_width))
+    matrix = np.zeros((len(spectra), n_bins), dtype=dtype)
+    for row, spectrum in enumerate(spectra):
+        vector = spectrum_to_binned_vector(
+            spectrum, mz_min, mz_max, bin_width, sqrt_intensity
+        )
+        norm = np.linalg.norm(vector)
+        if norm > 0:
+            matrix[row] = vector / norm
+    return matrix
+
+
+def binned_cosine_scores(
+    library_spectra: List[Spectrum],
+    query_spectra: List[Spectrum],
+    **binning
+) -> np.ndarray:
+    """
+    Cosine scores between binned spectra as one matrix product.
+    
+    The library matrix is stored as float16 to halve its memory footprint and
+    widened to float32 BINNED_BLOCK_ROWS rows at a time for the product.
+    
+    Args:
+        library_spectra: List of library matchms Spectrum objects
+        query_spectra: List of query matchms Spectrum objects
+        **binning: Binning parameters for binned_spectra_matrix
+        
+    Returns:
+        float32 score matrix of shape (library, query)
+    """
+    library_matrix = binned_spectra_matrix(library_spectra, dtype=np.float16, **binning)
+    query_matrix = binned_spectra_matrix(query_spectra, **binning)
+    
+    scores = np.empty((len(library_spectra), len(query_spectra)), dtype=np.float32)
+    for start in range(0, len(library_spectra), BINNED_BLOCK_ROWS):
+        block = library_matrix[start:start + BINNED_BLOCK_ROWS].astype(np.float32)
+        np.matmul(block, query_matrix.T, out=scores[start:start + BINNED_BLOCK_ROWS])
+    return scores
+
+
+@functools.lru_cache(maxsize=1)
+def _get_torch_cuda() -> Optional[Tuple[Any, Any]]:
+    """
+    Return ``(torch, device)`` if PyTorch can use a CUDA device, else None.
+    
+    PyTorch is imported on first use rather than at module import, as it
+    is slow to import and only needed for gpu_cosine.
+    """
+    try:
+        import torch
+    except ImportError:
+        print("Warning: PyTorch not available, gpu_cosine runs on the CPU. Install with: pip install torch")
+        return None
+    if not torch.cuda.is_available():
+        print("Warning: No CUDA device available, gpu_cosine runs on the CPU")
+        return None
+    return torch, torch.device("cuda")
+
+
+# Binned library matrix already uploaded to the GPU, keyed by a digest of its peaks
+_gpu_library_cache: Dict[str, Any] = {}
+
+
+def _gpu_library_matrix(
+    library_spectra: List[Spectrum],
+    prepared: PreparedSpectra,
+    torch: Any,
+    device: Any
+) -> Any:
+    """Return the binned library matrix on the GPU, uploading it only when the library changes."""
+    digest = hashlib.blake2b(digest_size=16)
+    for array in (prepared.mz, prepared.intensities, prepared.offsets):
+        digest.update(np.ascontiguousarray(array))
+    key = digest.hexdigest()
+    
+    if key not in _gpu_library_cache:
+        # Keep a single library on the GPU at a time
+        _gpu_library_cache.clear()
+        _gpu_library_cache[key] = torch.from_numpy(
+            binned_spectra_matrix(library_spectra, dtype=np.float16)
+        ).to(device)
+    return _gpu_library_cache[key]
+
+
+def gpu_cosine_scores(
+    library_spectra: List[Spectrum],
+    query_spectra: List[Spectrum],
+    top_n: int,
+    candidate_sets: Optional[List[np.ndarray]] = None,
+    library: Optional[PreparedSpectra] = None
+) -> np.ndarray:
+    """
+    Binned cosine scores computed on a CUDA GPU with PyTorch.
+    
+    The binned library matrix is uploaded once as float16 and reused while
+    the library is unchanged. Queries are scored in batches of GPU_QUERY_BATCH as one
+    matrix product each, and only every query's top_n scores are copied
+    back. Without PyTorch or a CUDA device, falls back to
+    binned_cosine_scores on the CPU.
+    
+    Args:
+        library_spectra: List of library matchms Spectrum objects
+        query_spectra: List of query matchms Spectrum objects
+        top_n: Number of top scores to keep per query
+        candidate_sets: Optional library indices each query may match
+        library: Prepared peaks of library_spectra, if already available
+        
+    Returns:
+        Score matrix of shape (library, query); on the GPU path, entries
+        outside each query's top_n are -inf
+    """
+    torch_cuda = _get_torch_cuda()
+    if torch_cuda is None:
+        return binned_cosine_scores(library_spectra, query_spectra)
+    torch, device = torch_cuda
+    
+    n_library = len(library_spectra)
+    scores = np.full((n_library, len(query_spectra)), -np.inf)
+    k = min(top_n, n_library)
+    if k == 0 or not query_spectra:
+        return scores
+    
+    if library is None:
+        library = prepare_spectra(library_spectra)
+    library_matrix = _gpu_library_matrix(library_spectra, library, torch, device)
+    query_matrix = binned_spectra_matrix(query_spectra, dtype=np.float16)
+    
+    for start in range(0, len(query_spectra), GPU_QUERY_BATCH):
+        batch = torch.from_numpy(query_matrix[start:start + GPU_QUERY_BATCH]).to(device)
+        batch_scores = batch @ library_matrix.T
+        
+        if candidate_sets is not None:
+            allowed = np.zeros((batch.shape[0], n_library), dtype=bool)
+            for row, candidates in enumerate(candidate_sets[start:start + GPU_QUERY_BATCH]):
+                allowed[row, candidates] = True
+            batch_scores.masked_fill_(~torch.from_numpy(allowed).to(device), float("-inf"))
+        
+        top_scores, top_indices = torch.topk(batch_scores, k, dim=1)
+        query_columns = np.arange(start, start + batch.shape[0])[:, None]
+        scores[top_indices.cpu().numpy(), query_columns] = top_scores.float().cpu().numpy()
+    
+    return scores
+
+
+def binned_spectra_csr(
+    spectra: List[Spectrum],
+    n_bins: int,
+    bin_width: float = SPARSE_BIN_WIDTH,
+    sqrt_intensity: bool = True
+) -> sparse.csr_matrix:
+    """
+    Build a row-normalized sparse (n_spectra, n_bins) matrix of binned spectra.
+    
+    Only occupied bins are stored, so fine bins suitable for high-resolution
+    data cost memory proportional to the number of peaks.
+    
+    Args:
+        spectra: List of matchms Spectrum objects
+        n_bins: Number of m/z bins (columns); peaks beyond the last bin are dropped
+        bin_width: Bin width (Da)
+        sqrt_intensity: Whether to square-root the binned intensities
+        
+    Returns:
+        CSR matrix whose rows have unit L2 norm (empty rows stay empty)
+    """
+    peaks = [spectrum_peaks(spectrum) for spectrum in spectra]
+    counts = [len(mz) for mz, _ in peaks]
+    if sum(counts) == 0:
+        return sparse.csr_matrix((len(spectra), n_bins), dtype=np.float32)
+    
+    mz = np.concatenate([np.asarray(mz) for mz, _ in peaks])
+    intensities = np.concatenate([
+        np.asarray(intensities, dtype=np.float32) for _, intensities in peaks
+    ])
+    rows = np.repeat(np.arange(len(spectra), dtype=np.int32), counts)
+    cols = (mz / bin_width).astype(np.int32)
+    
+    keep = cols < n_bins
+    matrix = sparse.csr_matrix(
+        (intensities[keep], (rows[keep], cols[keep])),
+        shape=(len(spectra), n_bins),
+        dtype=np.float32
+    )
+    # Peaks sharing a bin are summed when building the matrix
+    matrix.sum_duplicates()
+    if sqrt_intensity:
+        np.sqrt(matrix.data, out=matrix.data)
+    
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+    inverse_norms = np.divide(1.0, norms, out=np.zeros_like(norms), where=norms > 0)
+    return sparse.diags(inverse_norms.astype(np.float32)) @ matrix
+
+
+def sparse_cosine_scores(
+    library_spectra: List[Spectrum],
+    query_spectra: List[Spectrum],
+    bin_width: float = SPARSE_BIN_WIDTH,
+    sqrt_intensity: bool = True
+) -> sparse.csr_matrix:
+    """
+    Cosine scores between finely binned spectra as one sparse matrix product.
+    
+    Args:
+        library_spectra: List of library matchms Spectrum objects
+        query_spectra: List of query matchms Spectrum objects
+        bin_width: Bin width (Da)
+        sqrt_intensity: Whether to square-root the binned intensities
+        
+    Returns:
+        Sparse score matrix of shape (library, query); pairs sharing no bin
+        are implicit zeros
+    """
+    max_mz = max(
+        (float(mz[-1]) for mz, _ in map(spectrum_peaks, (*library_spectra, *query_spectra)) if len(mz)),
+        default=0.0
+    )
+    n_bins = int(max_mz / bin_width) + 1
+    
+    library_matrix = binned_spectra_csr(library_spectra, n_bins, bin_width, sqrt_intensity)
+    query_matrix = binned_spectra_csr(query_spectra, n_bins, bin_width, sqrt_intensity)
+    return library_matrix @ query_matrix.T
+
+
+def _build_match(
+    lib_spectrum: Spectrum,
+    lib_index: int,
+    similarity_score: float,
+    algorithm: str,
+    matched_peaks: int,
+    total_peaks: int
+) -> Dict[str, Any]:
+    """Build the result dictionary for one query/library match."""
+    return {
+        "library_id": lib_spectrum.get("spectrum_id", f"lib_{lib_index}"),
+        "compound_name": lib_spectrum.get("compound_name") or \
+                       lib_spectrum.get("name", "Unknown"),
+        "score": similarity_score,
+        "algorithm": algorithm,
+        "matched_peaks": matched_peaks,
+        "total_peaks": total_peaks,
+        "metadata": {
+            "precursor_mz": lib_spectrum.get("precursor_mz"),
+            "retention_time": lib_spectrum.get("retention_time"),
+            "smiles": lib_spectrum.get("smiles"),
+            "inchi": lib_spectrum.get("inchi"),
+            "inchikey": lib_spectrum.get("inchikey")
+        }
+    }
+
+
 def count_matched_peaks(
     spectrum1: Spectrum,
     spectrum2: Spectrum,
@@ -118,24 +897,69 @@ def count_matched_peaks(
     Returns:
         Number of matched peaks
     """
-    mz1 = spectrum1.peaks.mz
-    mz2 = spectrum2.peaks.mz
+    # matchms keeps peaks sorted by m/z; compare in float64 whatever the
+    # storage dtype so both code paths below count the same pairs
+    mz1 = np.asarray(spectrum_peaks(spectrum1)[0], dtype=np.float64)
+    mz2 = np.asarray(spectrum_peaks(spectrum2)[0], dtype=np.float64)
+    return _count_matched_mz(mz1, mz2, mz_tolerance)
+
+
+def _count_matched_mz(mz1: np.ndarray, mz2: np.ndarray, mz_tolerance: float) -> int:
+    """Count matched peaks between two m/z-sorted float64 arrays."""
+    if NUMBA_AVAILABLE:
+        return int(_count_matched(mz1, mz2, float(mz_tolerance)))
+    
+    n2 = len(mz2)
+    
+    # First peak of spectrum2 that can lie within tolerance of each peak of spectrum1
+    starts = np.searchsorted(mz2, mz1 - mz_tolerance, side="left").tolist()
     
+    # Plain Python floats and a bytearray flag per peak keep the interpreted
+    # loop free of NumPy scalar indexing
+    mz2_values = mz2.tolist()
+    used = bytearray(n2)
     matched = 0
-    used_indices = set()
     
-    for mz_val in mz1:
-        for j, mz_val2 in enumerate(mz2):
-            if j in used_indices:
-                continue
-            if abs(mz_val - mz_val2) <= mz_tolerance:
+    # Greedily pair each peak with the lowest unused peak inside its window
+    for mz_val, j in zip(mz1.tolist(), starts):
+        while j < n2 and mz2_values[j] - mz_val <= mz_tolerance:
+            if not used[j] and abs(mz_val - mz2_values[j]) <= mz_tolerance:
                 matched += 1
-                used_indices.add(j)
+                used[j] = 1
                 break
+            j += 1
+    
+    return matched
+
+
+def _count_matched(mz1: np.ndarray, mz2: np.ndarray, tolerance: float) -> int:
+    """
+    Count greedily paired peaks between two m/z-sorted arrays.
     
+    A single two-pointer sweep: with both arrays sorted, pairing each peak of
+    mz1 with the lowest unused peak of mz2 within tolerance never needs to
+    look back, so this matches the greedy search in _count_matched_mz.
+    """
+    i = 0
+    j = 0
+    matched = 0
+    while i < len(mz1) and j < len(mz2):
+        diff = mz1[i] - mz2[j]
+        if abs(diff) <= tolerance:
+            matched += 1
+            i += 1
+            j += 1
+        elif diff < 0:
+            i += 1
+        else:
+            j += 1
     return matched
 
 
+if NUMBA_AVAILABLE:
+    _count_matched = njit(cache=True, fastmath=True)(_count_matched)
+
+
 def calculate_dot_product(
     spectrum1: Spectrum,
     spectrum2: Spectrum,
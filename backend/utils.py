@@ -1,22 +1,68 @@
 """Utility functions."""
+import functools
 import hashlib
 import json
+import multiprocessing
+import os
 from pathlib import Path
 from typing import Dict, Any
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+HASH_CHUNK_SIZE = 1024 * 1024  # 1 MiB reads when hashlib.file_digest is unavailable
+
 
 def generate_file_hash(file_path: Path) -> str:
     """Generate MD5 hash of a file."""
-    hash_md5 = hashlib.md5()
     with open(file_path, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
+        # Python 3.11+ hashes the file in a C loop without per-chunk Python overhead
+        if hasattr(hashlib, "file_digest"):
+            return hashlib.file_digest(f, "md5").hexdigest()
+        
+        hash_md5 = hashlib.md5()
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
             hash_md5.update(chunk)
     return hash_md5.hexdigest()
 
 
+@functools.lru_cache(maxsize=1)
+def worker_mp_context() -> multiprocessing.context.BaseContext:
+    """
+    Start method for worker process pools.
+    
+    Workers are never forked: forking the multi-threaded server, or any
+    process after a Numba parallel kernel, BLAS or torch has started its
+    threads, can hang the child. The forkserver preloads the matching
+    modules so workers start without re-importing them.
+    """
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("forkserver")
+        context.set_forkserver_preload(["backend.spectral_matcher", "backend.ms2_extractor"])
+        return context
+    return multiprocessing.get_context("spawn")
+
+
+def advise_will_need(file_path: Path) -> None:
+    """Ask the OS to read a file into the page cache ahead of use (POSIX only)."""
+    if not hasattr(os, "posix_fadvise"):
+        return
+    fd = os.open(file_path, os.O_RDONLY)
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+    finally:
+        os.close(fd)
+
+
 def safe_json_load(file_path: Path) -> Dict[str, Any]:
     """Safely load JSON file."""
     try:
+        if orjson is not None:
+            # orjson.JSONDecodeError subclasses json.JSONDecodeError
+            return orjson.loads(Path(file_path).read_bytes())
         with open(file_path, 'r', encoding='utf-8') as f:
             return json.load(f)
     except (json.JSONDecodeError, FileNotFoundError) as e:
@@ -26,10 +72,16 @@ def safe_json_load(file_path: Path) -> Dict[str, Any]:
 def safe_json_save(data: Dict[str, Any], file_path: Path) -> bool:
     """Safely save data to JSON file."""
     try:
+        if orjson is not None:
+            # NumPy arrays and scalars are serialized natively
+            Path(file_path).write_bytes(orjson.dumps(
+                data,
+                option=orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+            ))
+            return True
         with open(file_path, 'w', encoding='utf-8') as f:
             json.dump(data, f, indent=2, ensure_ascii=False)
         return True
     except Exception as e:
         print(f"Error saving JSON: {e}")
         return False
-
@@ -1,13 +1,95 @@
 """XCMS processing module for peak detection and alignment."""
+import functools
 import subprocess
 import json
 import tempfile
+import threading
 from pathlib import Path
 from typing import List, Dict, Any, Optional
 import pandas as pd
 from backend.config import UPLOAD_DIR, RESULTS_DIR
 from backend.errors import XCMSProcessingError
 
+try:
+    import rpy2.robjects as ro
+    from rpy2.rinterface_lib.embedded import RRuntimeError
+    RPY2_AVAILABLE = True
+except Exception:
+    # ImportError, or rpy2 installed but unable to locate an R installation
+    RPY2_AVAILABLE = False
+
+# Embedded R is single-threaded; serialize calls into the shared session
+_R_SESSION_LOCK = threading.Lock()
+
+XCMS_R_LIBRARIES = """
+suppressMessages(library(xcms))
+suppressMessages(library(CAMERA))
+"""
+
+# The XCMS pipeline as an R function, defined once per R session (rpy2) or
+# at the top of a generated script (Rscript)
+XCMS_PIPELINE_R = """
+process_xcms <- function(mzxml_files, output_dir, peak_detection_method, ppm,
+                         peakwidth, snthresh, mzdiff, prefilter,
+                         peak_grouping_method, bw, mzwid, minfrac, minsamp,
+                         rt_correction_method) {
+    # Create output directory
+    dir.create(output_dir, showWarnings = FALSE, recursive = TRUE)
+
+    # Load files
+    xset <- xcmsSet(
+        files = mzxml_files,
+        method = peak_detection_method,
+        ppm = ppm,
+        peakwidth = peakwidth,
+        snthresh = snthresh,
+        mzdiff = mzdiff,
+        prefilter = prefilter
+    )
+
+    # Group peaks
+    xset <- group(
+        xset,
+        method = peak_grouping_method,
+        bw = bw,
+        mzwid = mzwid,
+        minfrac = minfrac,
+        minsamp = minsamp
+    )
+
+    # Retention time correction
+    xset <- retcor(xset, method = rt_correction_method)
+
+    # Regroup after RT correction
+    xset <- group(
+        xset,
+        method = peak_grouping_method,
+        bw = bw,
+        mzwid = mzwid,
+        minfrac = minfrac,
+        minsamp = minsamp
+    )
+
+    # Fill peaks
+    xset <- fillPeaks(xset)
+
+    # Generate and save peak table
+    peak_table <- peakTable(xset)
+    write.csv(peak_table, file = file.path(output_dir, "PeakTable_verbose.csv"), row.names = FALSE)
+
+    # Generate sample info
+    sample_names <- basename(mzxml_files)
+    sample_info <- data.frame(
+        sample.name = sample_names,
+        group = rep(".", length(sample_names)),
+        stringsAsFactors = FALSE
+    )
+    write.csv(sample_info, file = file.path(output_dir, "sample.info.csv"), row.names = FALSE)
+
+    invisible(peak_table)
+}
+"""
+
 
 def process_with_xcms(
     mzxml_files: List[Path],
@@ -62,31 +144,31 @@ def get_default_xcms_params() -> Dict[str, Any]:
     }
 
 
+@functools.lru_cache(maxsize=1)
 def check_r_xcms_available() -> bool:
-    """Check if R with XCMS package is available."""
+    """
+    Check if R with XCMS package is available.
+    
+    The result is cached for the life of the process; call
+    _reset_availability_cache() after installing R or XCMS.
+    """
     try:
-        result = subprocess.run(
-            ["Rscript", "--version"],
+        # A missing Rscript raises FileNotFoundError, so one call checks both
+        check_xcms = subprocess.run(
+            ["Rscript", "-e", "library(xcms)"],
             capture_output=True,
             text=True,
-            timeout=5
+            timeout=10
         )
-        if result.returncode == 0:
-            # Check if XCMS is installed
-            check_xcms = subprocess.run(
-                ["Rscript", "-e", "library(xcms)"],
-                capture_output=True,
-                text=True,
-                timeout=10
-            )
-            return check_xcms.returncode == 0
+        return check_xcms.returncode == 0
     except (FileNotFoundError, subprocess.TimeoutExpired):
         pass
     return False
 
 
+@functools.lru_cache(maxsize=1)
 def check_pyopenms_available() -> bool:
-    """Check if pyOpenMS is available."""
+    """Check if pyOpenMS is available (cached like check_r_xcms_available)."""
     try:
         import pyopenms
         return True
@@ -94,6 +176,12 @@ def check_pyopenms_available() -> bool:
         return False
 
 
+def _reset_availability_cache() -> None:
+    """Forget cached XCMS availability so the next check runs again."""
+    check_r_xcms_available.cache_clear()
+    check_pyopenms_available.cache_clear()
+
+
 def process_with_r_xcms(
     mzxml_files: List[Path],
     output_dir: Path,
@@ -112,6 +200,70 @@ def process_with_r_xcms(
     """
     output_dir.mkdir(parents=True, exist_ok=True)
     
+    if RPY2_AVAILABLE:
+        _run_xcms_in_r_session(mzxml_files, output_dir, params)
+    else:
+        _run_xcms_with_rscript(mzxml_files, output_dir, params)
+    
+    # Check for output files
+    peak_table_path = output_dir / "PeakTable_verbose.csv"
+    sample_info_path = output_dir / "sample.info.csv"
+    
+    if not peak_table_path.exists():
+        raise XCMSProcessingError("Peak table file not generated")
+    
+    return {
+        "success": True,
+        "peak_table": str(peak_table_path),
+        "sample_info": str(sample_info_path) if sample_info_path.exists() else None,
+        "output_dir": str(output_dir),
+        "message": "XCMS processing completed successfully"
+    }
+
+
+@functools.lru_cache(maxsize=1)
+def _get_r_pipeline() -> Any:
+    """Load XCMS into the embedded R session once and return the pipeline function."""
+    ro.r(XCMS_R_LIBRARIES)
+    ro.r(XCMS_PIPELINE_R)
+    return ro.globalenv["process_xcms"]
+
+
+def _run_xcms_in_r_session(
+    mzxml_files: List[Path],
+    output_dir: Path,
+    params: Dict[str, Any]
+) -> None:
+    """Run the XCMS pipeline in the persistent rpy2 R session."""
+    args = _xcms_pipeline_args(mzxml_files, output_dir, params)
+    try:
+        with _R_SESSION_LOCK:
+            _get_r_pipeline()(
+                ro.StrVector(args["mzxml_files"]),
+                args["output_dir"],
+                args["peak_detection_method"],
+                args["ppm"],
+                ro.FloatVector(args["peakwidth"]),
+                args["snthresh"],
+                args["mzdiff"],
+                ro.FloatVector(args["prefilter"]),
+                args["peak_grouping_method"],
+                args["bw"],
+                args["mzwid"],
+                args["minfrac"],
+                args["minsamp"],
+                args["rt_correction_method"]
+            )
+    except RRuntimeError as e:
+        raise XCMSProcessingError(f"XCMS processing failed: {str(e)}")
+
+
+def _run_xcms_with_rscript(
+    mzxml_files: List[Path],
+    output_dir: Path,
+    params: Dict[str, Any]
+) -> None:
+    """Run the XCMS pipeline in a fresh Rscript process."""
     # Create R script for XCMS processing
     r_script = generate_xcms_r_script(mzxml_files, output_dir, params)
     
@@ -131,102 +283,66 @@ def process_with_r_xcms(
         
         if result.returncode != 0:
             raise XCMSProcessingError(f"XCMS processing failed: {result.stderr}")
-        
-        # Check for output files
-        peak_table_path = output_dir / "PeakTable_verbose.csv"
-        sample_info_path = output_dir / "sample.info.csv"
-        
-        if not peak_table_path.exists():
-            raise XCMSProcessingError("Peak table file not generated")
-        
-        return {
-            "success": True,
-            "peak_table": str(peak_table_path),
-            "sample_info": str(sample_info_path) if sample_info_path.exists() else None,
-            "output_dir": str(output_dir),
-            "message": "XCMS processing completed successfully"
-        }
     finally:
         # Clean up temporary R script
         if r_script_path.exists():
             r_script_path.unlink()
 
 
+def _xcms_pipeline_args(
+    mzxml_files: List[Path],
+    output_dir: Path,
+    params: Dict[str, Any]
+) -> Dict[str, Any]:
+    """Collect the arguments of the R process_xcms function, applying defaults."""
+    return {
+        "mzxml_files": [str(f.absolute()) for f in mzxml_files],
+        "output_dir": str(output_dir.absolute()),
+        "peak_detection_method": params.get("peak_detection_method", "centWave"),
+        "ppm": params.get("ppm", 10),
+        "peakwidth": list(params.get("peakwidth", [5, 30])),
+        "snthresh": params.get("snthresh", 6),
+        "mzdiff": params.get("mzdiff", 0.01),
+        "prefilter": list(params.get("prefilter", [3, 100])),
+        "peak_grouping_method": params.get("peak_grouping_method", "density"),
+        "bw": params.get("bw", 5),
+        "mzwid": params.get("mzwid", 0.006),
+        "minfrac": params.get("minfrac", 0.5),
+        "minsamp": params.get("minsamp", 0),
+        "rt_correction_method": params.get("rt_correction_method", "obiwarp")
+    }
+
+
 def generate_xcms_r_script(
     mzxml_files: List[Path],
     output_dir: Path,
     params: Dict[str, Any]
 ) -> str:
     """Generate R script for XCMS processing."""
-    file_paths = [str(f.absolute()) for f in mzxml_files]
-    file_paths_str = "c(" + ", ".join([f'"{p}"' for p in file_paths]) + ")"
+    args = _xcms_pipeline_args(mzxml_files, output_dir, params)
+    file_paths_str = "c(" + ", ".join([f'"{p}"' for p in args["mzxml_files"]]) + ")"
     
     script = f"""
 # XCMS Processing Script
-library(xcms)
-library(CAMERA)
-
-# File paths
-mzxml_files <- {file_paths_str}
-output_dir <- "{output_dir.absolute()}"
-
-# Create output directory
-dir.create(output_dir, showWarnings = FALSE, recursive = TRUE)
-
-# Load files
-xset <- xcmsSet(
-    files = mzxml_files,
-    method = "{params.get('peak_detection_method', 'centWave')}",
-    ppm = {params.get('ppm', 10)},
-    peakwidth = c({params.get('peakwidth', [5, 30])[0]}, {params.get('peakwidth', [5, 30])[1]}),
-    snthresh = {params.get('snthresh', 6)},
-    mzdiff = {params.get('mzdiff', 0.01)},
-    prefilter = c({params.get('prefilter', [3, 100])[0]}, {params.get('prefilter', [3, 100])[1]})
-)
-
-# Group peaks
-xset <- group(
-    xset,
-    method = "{params.get('peak_grouping_method', 'density')}",
-    bw = {params.get('bw', 5)},
-    mzwid = {params.get('mzwid', 0.006)},
-    minfrac = {params.get('minfrac', 0.5)},
-    minsamp = {params.get('minsamp', 0)}
-)
-
-# Retention time correction
-xset <- retcor(
-    xset,
-    method = "{params.get('rt_correction_method', 'obiwarp')}"
-)
-
-# Regroup after RT correction
-xset <- group(
-    xset,
-    method = "{params.get('peak_grouping_method', 'density')}",
-    bw = {params.get('bw', 5)},
-    mzwid = {params.get('mzwid', 0.006)},
-    minfrac = {params.get('minfrac', 0.5)},
-    minsamp = {params.get('minsamp', 0)}
-)
-
-# Fill peaks
-xset <- fillPeaks(xset)
-
-# Generate peak table
-peak_table <- peakTable(xset)
-
-# Save peak table
-write.csv(peak_table, file = file.path(output_dir, "PeakTable_verbose.csv"), row.names = FALSE)
+{XCMS_R_LIBRARIES}
+{XCMS_PIPELINE_R}
 
-# Generate sample info
-sample_names <- basename(mzxml_files)
-sample_info <- data.frame(
-    sample.name = sample_names,
-    group = rep(".", length(sample_names)),
-    stringsAsFactors = FALSE
+process_xcms(
+    mzxml_files = {file_paths_str},
+    output_dir = "{args['output_dir']}",
+    peak_detection_method = "{args['peak_detection_method']}",
+    ppm = {args['ppm']},
+    peakwidth = c({args['peakwidth'][0]}, {args['peakwidth'][1]}),
+    snthresh = {args['snthresh']},
+    mzdiff = {args['mzdiff']},
+    prefilter = c({args['prefilter'][0]}, {args['prefilter'][1]}),
+    peak_grouping_method = "{args['peak_grouping_method']}",
+    bw = {args['bw']},
+    mzwid = {args['mzwid']},
+    minfrac = {args['minfrac']},
+    minsamp = {args['minsamp']},
+    rt_correction_method = "{args['rt_correction_method']}"
 )
-write.csv(sample_info, file = file.path(output_dir, "sample.info.csv"), row.names = FALSE)
 
 cat("XCMS processing completed successfully\\n")
 """
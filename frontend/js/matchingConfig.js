@@ -23,7 +23,8 @@ document.getElementById('run-matching')?.addEventListener('click', async () => {
             mz_tolerance: parseFloat(document.getElementById('mz-tolerance').value),
             rt_tolerance: parseFloat(document.getElementById('rt-tolerance').value),
             min_score: parseFloat(document.getElementById('min-score').value),
-            top_n: parseInt(document.getElementById('top-n').value)
+            top_n: parseInt(document.getElementById('top-n').value),
+            precursor_tolerance_ppm: parseFloat(document.getElementById('precursor-ppm').value) || null
         };
         
         // Extract MS2 spectra from first mzXML file